@@ -0,0 +1 @@
+"""オフラインベンチマーク（Yahoo Finance / Google News のスタブサーバーを使用）"""
@@ -0,0 +1,146 @@
+"""
+ニュース本文処理のマイクロベンチマーク。
+
+RSS コーパス（録画済みの XML ファイル群、なければスタブサーバーと同じ生成器で合成）を
+feedparser で一度だけ解析し、記事ごとの処理時間を次の3つで比較する。
+
+- 従来実装: 変更前のコードそのもの（ループ内 re.sub + any() 走査。言及検出はしない）
+- 従来実装+言及検出: 上に保有銘柄ごとの素朴な部分文字列検索を足したもの
+- NewsTextMatcher: タグ除去・カテゴリ判定・言及検出を1回の走査で行う現在の実装
+
+NewsTextMatcher は言及検出の分だけ仕事が多いため、従来実装よりは遅い。
+同じ仕事をする「従来実装+言及検出」と比べて初めて速度を比較できる。
+
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.news_text_benchmark
+    python -m benchmarks.news_text_benchmark --corpus path/to/rss_dir --holdings 500
+    python -m benchmarks.news_text_benchmark --record path/to/rss_dir --holdings 20   # 実フィードを録画
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import time
+from urllib.parse import quote
+
+import feedparser
+import requests
+
+from benchmarks.run_benchmark import _make_holdings
+from benchmarks.stub_server import StubConfig, _rss_payload
+from news_fetcher import GOOGLE_NEWS_BASE_URL, NewsTextMatcher
+
+
+def _legacy_process(title: str, summary: str) -> tuple[str, str]:
+    """変更前の処理（HTMLタグ除去とカテゴリ判定のみ）"""
+    import re as _re
+    summary = _re.sub(r"<[^>]+>", "", summary)
+    if any(w in title for w in ["配当", "増配", "減配", "配当金"]):
+        category = "配当"
+    elif any(w in title for w in ["決算", "業績", "売上", "利益", "黒字", "赤字"]):
+        category = "業績"
+    elif any(w in title for w in ["株価", "上昇", "下落", "高値", "安値", "反発"]):
+        category = "株価"
+    else:
+        category = "ニュース"
+    return summary, category
+
+
+def _legacy_with_mentions(title: str, summary: str, holdings: list[dict]) -> tuple[str, str, list[str]]:
+    """変更前の処理に、保有銘柄ごとの部分文字列検索による言及検出を足したもの"""
+    summary, category = _legacy_process(title, summary)
+    text = title + summary
+    mentioned = sorted({h["ticker"] for h in holdings if h["ticker"] in text or h["name"] in text})
+    return summary, category, mentioned
+
+
+def _load_corpus(corpus_dir: str | None, holdings: list[dict], items: int) -> list[tuple[str, str]]:
+    if corpus_dir:
+        raw_feeds = []
+        for path in sorted(glob.glob(os.path.join(corpus_dir, "*.xml"))):
+            with open(path, "rb") as f:
+                raw_feeds.append(f.read())
+    else:
+        config = StubConfig(payload_items=items)
+        raw_feeds = [_rss_payload(h["name"], config).encode("utf-8") for h in holdings]
+
+    articles = []
+    for raw in raw_feeds:
+        for entry in feedparser.parse(raw).entries:
+            articles.append((getattr(entry, "title", ""), getattr(entry, "summary", "")))
+    return articles
+
+
+def _record(corpus_dir: str, holdings: list[dict]) -> None:
+    os.makedirs(corpus_dir, exist_ok=True)
+    for h in holdings:
+        url = f"{GOOGLE_NEWS_BASE_URL}/rss/search?q={quote(h['name'])}&hl=ja&gl=JP&ceid=JP:ja"
+        resp = requests.get(url, timeout=10)
+        resp.raise_for_status()
+        with open(os.path.join(corpus_dir, f"{h['ticker']}.xml"), "wb") as f:
+            f.write(resp.content)
+    print(f"{len(holdings)}件のフィードを保存しました: {corpus_dir}")
+
+
+def _time(fn, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ニュース本文処理のマイクロベンチマーク")
+    parser.add_argument("--holdings", type=int, default=300, help="保有銘柄数（照合対象の銘柄数）")
+    parser.add_argument("--items", type=int, default=20, help="合成コーパスのフィードあたり記事数")
+    parser.add_argument("--corpus", default=None, help="録画済み RSS (*.xml) のディレクトリ")
+    parser.add_argument("--record", default=None, help="実フィードを録画して保存するディレクトリ")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    holdings = _make_holdings(args.holdings)
+    if args.record:
+        _record(args.record, holdings)
+        return
+
+    articles = _load_corpus(args.corpus, holdings, args.items)
+    print(f"記事数: {len(articles)} / 照合銘柄数: {len(holdings)}")
+
+    start = time.perf_counter()
+    matcher = NewsTextMatcher((h["ticker"], h["name"]) for h in holdings)
+    print(f"照合器のコンパイル: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    legacy = _time(lambda: [_legacy_process(t, s) for t, s in articles], args.repeat)
+    naive = _time(lambda: [_legacy_with_mentions(t, s, holdings) for t, s in articles], args.repeat)
+    current = _time(lambda: [matcher.process(t, s) for t, s in articles], args.repeat)
+
+    for label, timings in (("従来実装", legacy), ("従来実装+言及検出", naive), ("NewsTextMatcher", current)):
+        median = statistics.median(timings)
+        print(f"{label:<16} 中央値 {median * 1000:9.2f}ms  記事あたり {median / len(articles) * 1e6:8.2f}µs")
+    current_median = statistics.median(current)
+    print(f"速度比（従来実装 / NewsTextMatcher）: {statistics.median(legacy) / current_median:.2f}x"
+          "  ※ NewsTextMatcher は言及検出も行う")
+    print(f"速度比（従来実装+言及検出 / NewsTextMatcher）: {statistics.median(naive) / current_median:.2f}x")
+
+    # 結果が一致することを確認（カテゴリとHTML除去は従来と同一であるべき）。
+    # 合成コーパスのタイトルには「<」が含まれないため、山括弧を使う見出しも加えて確かめる
+    h = holdings[0]
+    edge_cases = [
+        (f"増配 <{h['ticker']}>", ""),
+        (f"<決算>{h['name']}、最高益", f"<p>{h['name']}の<b>業績</b></p>"),
+        ("【株価】<高値更新> 日経平均", "<br/>"),
+    ]
+    mismatches = sum(
+        1 for t, s in articles + edge_cases
+        if _legacy_process(t, s) != matcher.process(t, s)[:2]
+    )
+    print(f"カテゴリ/要約の不一致: {mismatches}件")
+    missed = [t for t, _ in edge_cases[:2] if h["ticker"] not in matcher.process(t, "")[2]]
+    print(f"山括弧付き見出しでの言及の取りこぼし: {len(missed)}件")
+
+
+if __name__ == "__main__":
+    main()
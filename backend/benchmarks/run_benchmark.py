@@ -0,0 +1,301 @@
+"""
+オフラインベンチマーク。
+
+ローカルのスタブサーバーを起動し、YAHOO_BASE_URL / GOOGLE_NEWS_BASE_URL をそこへ向けた状態で
+FastAPI アプリを uvicorn で立ち上げ、主要エンドポイントのスループットと p50/p99 レイテンシを
+保有銘柄数 10 / 100 / 1000 で計測する。
+
+- スタブサーバーとアプリはそれぞれ別プロセスで動かし、負荷をかける側と GIL を取り合わないようにする
+- アプリは計測ごとに起動し直し、メモリ上のキャッシュが空の状態から測る
+- データファイルは環境変数で一時ディレクトリに向けるため、data/stocks.json や価格キャッシュには触れない
+- p99 はサンプル数が少ないとほぼ最大値になるため、結果にはサンプル数も併記する
+
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.run_benchmark
+    python -m benchmarks.run_benchmark --sizes 10 100 --requests 50 --latency-ms 30
+    python -m benchmarks.run_benchmark --baseline benchmarks/results/20260101-120000.json
+
+結果は benchmarks/results/<日時>.json に保存される。--baseline を指定すると前回結果との差分を表示する。
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from benchmarks.stub_server import StubConfig
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# (メソッド, パス) — 計測対象のエンドポイント
+ENDPOINTS = [
+    ("GET", "/api/portfolio"),
+    ("GET", "/api/dividends"),
+    ("GET", "/api/news"),
+    ("POST", "/api/portfolio/refresh"),
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _make_holdings(count: int) -> list[dict]:
+    holdings = []
+    for i in range(count):
+        ticker = str(1301 + i)
+        holdings.append({
+            "ticker": ticker,
+            "name": f"ベンチ銘柄{ticker}",
+            "shares": 100,
+            "average_cost": 1000.0,
+            "current_price": 1000.0,
+            "market_value": 100000.0,
+            "annual_dividend_per_share": 30.0,
+            "sector": "その他",
+        })
+    return holdings
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class _Process:
+    """サーバーを子プロセスとして起動し、応答するまで待つ"""
+
+    def __init__(self, args: list[str], ready_url: str, env: dict | None = None):
+        self._args = args
+        self._ready_url = ready_url
+        self._env = env
+        self._proc: subprocess.Popen | None = None
+
+    def start(self) -> "_Process":
+        self._proc = subprocess.Popen(
+            [sys.executable, *self._args],
+            cwd=BACKEND_DIR,
+            env={**os.environ, **(self._env or {})},
+            stdout=subprocess.DEVNULL,
+        )
+        deadline = time.time() + 30
+        while True:
+            if self._proc.poll() is not None:
+                raise RuntimeError(f"サーバーが終了しました: {' '.join(self._args)}")
+            try:
+                requests.get(self._ready_url, timeout=1)
+                return self
+            except requests.RequestException:
+                pass
+            if time.time() > deadline:
+                self.stop()
+                raise RuntimeError(f"サーバーの起動がタイムアウトしました: {' '.join(self._args)}")
+            time.sleep(0.1)
+
+    def stop(self) -> None:
+        if self._proc is None:
+            return
+        self._proc.terminate()
+        try:
+            self._proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+        self._proc = None
+
+
+def _app_env(data_dir: str, stub_url: str) -> dict:
+    """アプリの接続先とデータファイルの保存先を環境変数で一時ディレクトリへ向ける"""
+    return {
+        "YAHOO_BASE_URL": stub_url,
+        "GOOGLE_NEWS_BASE_URL": stub_url,
+        "PORTFOLIO_STOCKS_FILE": os.path.join(data_dir, "stocks.json"),
+        "PORTFOLIOS_DIR": os.path.join(data_dir, "portfolios"),
+        "PRICE_CACHE_FILE": os.path.join(data_dir, "price_cache.json"),
+        "DIVIDEND_EVENTS_FILE": os.path.join(data_dir, "dividend_events.json"),
+        "FIRESTORE_JOURNAL_FILE": os.path.join(data_dir, "firestore_journal.jsonl"),
+        "PROFILE_DIR": os.path.join(data_dir, "profiles"),
+        # バックグラウンドの株価先読みは計測をぶれさせるので止めておく
+        "PORTFOLIO_WARM_INTERVAL": "0",
+    }
+
+
+def _reset_data(data_dir: str, holdings: list[dict]) -> None:
+    """保有銘柄を書き込み、価格キャッシュ・配当イベントを消して初期状態にする"""
+    for name in ("price_cache.json", "dividend_events.json"):
+        path = os.path.join(data_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+    with open(os.path.join(data_dir, "stocks.json"), "w", encoding="utf-8") as f:
+        json.dump({"holdings": holdings}, f, ensure_ascii=False)
+
+
+def _measure(base_url: str, method: str, path: str, total: int, concurrency: int) -> dict:
+    """1エンドポイントを total 回叩いてレイテンシとスループットを集計する"""
+    session = requests.Session()
+    url = base_url + path
+
+    def _call(_):
+        start = time.perf_counter()
+        resp = session.request(method, url, timeout=600)
+        elapsed = time.perf_counter() - start
+        return elapsed, resp.status_code
+
+    # ウォームアップ（初回の価格キャッシュ作成などを計測から除外）
+    _call(None)
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(_call, range(total)))
+    wall = time.perf_counter() - wall_start
+
+    latencies_ms = [r[0] * 1000 for r in results]
+    errors = sum(1 for r in results if r[1] >= 400)
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": round(total / wall, 2) if wall > 0 else 0.0,
+        "p50_ms": round(statistics.median(latencies_ms), 2),
+        "p99_ms": round(_percentile(latencies_ms, 99), 2),
+        "mean_ms": round(statistics.fmean(latencies_ms), 2),
+    }
+
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, timeout=5, cwd=os.path.dirname(__file__),
+        )
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _print_comparison(current: dict, baseline: dict) -> None:
+    """前回結果との差分（%）を表示する。レイテンシは増加、スループットは減少が悪化。"""
+    base_index = {
+        (r["holdings"], r["endpoint"]): r for r in baseline.get("results", [])
+    }
+    print("\n=== ベースライン比較 ===")
+    print(f"{'holdings':>8}  {'endpoint':<28} {'p50':>9} {'p99':>9} {'rps':>9}")
+    for r in current["results"]:
+        base = base_index.get((r["holdings"], r["endpoint"]))
+        if not base:
+            continue
+
+        def _delta(key):
+            if not base[key]:
+                return "    n/a"
+            return f"{(r[key] - base[key]) / base[key] * 100:+7.1f}%"
+
+        print(f"{r['holdings']:>8}  {r['endpoint']:<28} {_delta('p50_ms'):>9} {_delta('p99_ms'):>9} {_delta('throughput_rps'):>9}")
+
+
+def run(args) -> dict:
+    stub_config = StubConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        payload_items=args.payload_items,
+    )
+    stub_port = _free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    stub = _Process(
+        [
+            "-m", "benchmarks.stub_server", "--port", str(stub_port),
+            "--latency-ms", str(stub_config.latency_ms), "--jitter-ms", str(stub_config.jitter_ms),
+            "--error-rate", str(stub_config.error_rate), "--payload-items", str(stub_config.payload_items),
+        ],
+        ready_url=f"{stub_url}/v1/finance/search?q=ready",
+    ).start()
+    data_dir = tempfile.mkdtemp(prefix="bench-data-")
+
+    results = []
+    try:
+        for size in args.sizes:
+            holdings = _make_holdings(size)
+            for method, path in ENDPOINTS:
+                # 計測ごとにデータを初期状態へ戻し、アプリを起動し直す
+                _reset_data(data_dir, holdings)
+                port = _free_port()
+                app = _Process(
+                    ["-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+                     "--log-level", "warning"],
+                    ready_url=f"http://127.0.0.1:{port}/health",
+                    env=_app_env(data_dir, stub_url),
+                ).start()
+                try:
+                    stats = _measure(f"http://127.0.0.1:{port}", method, path, args.requests, args.concurrency)
+                finally:
+                    app.stop()
+                stats.update({"holdings": size, "endpoint": f"{method} {path}"})
+                results.append(stats)
+                print(
+                    f"holdings={size:<5} {method:<4} {path:<26} "
+                    f"rps={stats['throughput_rps']:<8} p50={stats['p50_ms']:<9}ms "
+                    f"p99={stats['p99_ms']:<9}ms (n={stats['requests']}) errors={stats['errors']}"
+                )
+    finally:
+        stub.stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": _git_revision(),
+        "python": sys.version.split()[0],
+        "stub": {
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate,
+            "payload_items": args.payload_items,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="オフラインベンチマーク（スタブサーバー使用）")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="保有銘柄数")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="エンドポイントごとのリクエスト数（p99 の信頼性のため 100 以上を推奨）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時リクエスト数")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="スタブの応答遅延")
+    parser.add_argument("--jitter-ms", type=float, default=5.0, help="スタブの遅延のばらつき")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="スタブが500を返す確率")
+    parser.add_argument("--payload-items", type=int, default=10, help="RSS記事数・配当イベント数")
+    parser.add_argument("--output", default=None, help="結果JSONの保存先（省略時は results/<日時>.json）")
+    parser.add_argument("--baseline", default=None, help="比較対象の過去結果JSON")
+    args = parser.parse_args()
+
+    report = run(args)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            _print_comparison(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Yahoo Finance / Google News RSS のローカルスタブサーバー。
+
+ベンチマークやオフライン開発で本物の外部APIを叩かないために使う。
+以下のエンドポイントを模倣する:
+- GET /v8/finance/chart/{symbol}   （events=div 付きなら配当イベントも返す）
+- GET /v1/finance/search?q=...
+- GET /rss/search?q=...            （Google News RSS）
+
+単体起動:
+    python -m benchmarks.stub_server --port 8765 --latency-ms 50 --error-rate 0.01
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+@dataclass
+class StubConfig:
+    latency_ms: float = 0.0     # 1リクエストあたりの応答遅延
+    jitter_ms: float = 0.0      # 遅延のばらつき（0〜jitter_ms を加算）
+    error_rate: float = 0.0     # 500 を返す確率（0.0〜1.0）
+    payload_items: int = 10     # RSS記事数・配当イベント数
+    summary_chars: int = 200    # RSS記事1件あたりの本文文字数
+
+
+_SECTORS = ["Technology", "Consumer Cyclical", "Financial Services", "Communication Services", "Industrials"]
+_TITLE_WORDS = ["増配を発表", "決算で増収増益", "株価が反発", "新製品を発表", "年初来高値を更新"]
+
+
+def _seed(text: str) -> int:
+    """シンボルから決定的な乱数シードを作る（実行ごとに同じ応答にするため）"""
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def _chart_payload(symbol: str, with_dividends: bool, config: StubConfig) -> dict:
+    seed = _seed(symbol)
+    price = 500 + seed % 9500
+    result = {
+        "meta": {
+            "symbol": symbol,
+            "longName": f"スタブ銘柄 {symbol}",
+            "shortName": symbol,
+            "regularMarketPrice": float(price),
+            "currency": "JPY",
+            "exchangeName": "JPX",
+        },
+    }
+    if with_dividends:
+        # 直近から半年おきに遡って配当イベントを生成
+        now = int(time.time())
+        per_share = round(price * 0.015, 1)
+        dividends = {}
+        for i in range(config.payload_items):
+            ts = now - (30 + i * 182) * 24 * 3600
+            dividends[str(ts)] = {"amount": per_share, "date": ts}
+        result["events"] = {"dividends": dividends}
+    return {"chart": {"result": [result], "error": None}}
+
+
+def _search_payload(symbol: str) -> dict:
+    seed = _seed(symbol)
+    return {
+        "quotes": [{
+            "symbol": symbol,
+            "quoteType": "EQUITY",
+            "sector": _SECTORS[seed % len(_SECTORS)],
+        }]
+    }
+
+
+def _rss_payload(query: str, config: StubConfig) -> str:
+    seed = _seed(query)
+    body = ("本文" * config.summary_chars)[:config.summary_chars]
+    items = []
+    for i in range(config.payload_items):
+        title = f"{query}、{_TITLE_WORDS[(seed + i) % len(_TITLE_WORDS)]}"
+        pub = formatdate(time.time() - i * 3600, usegmt=True)
+        description = f'<a href="#">{query}</a>&nbsp;<font>{body}</font>'
+        items.append(
+            "<item>"
+            f"<title>{escape(title)}</title>"
+            f"<link>https://stub.example.com/{seed}/{i}</link>"
+            f"<description>{escape(description)}</description>"
+            f"<pubDate>{pub}</pubDate>"
+            '<source url="https://stub.example.com">スタブ新聞</source>'
+            "</item>"
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<rss version="2.0"><channel><title>Stub News</title>'
+        + "".join(items)
+        + "</channel></rss>"
+    )
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    config: StubConfig = StubConfig()
+
+    def do_GET(self):
+        config = self.config
+        delay = config.latency_ms + random.uniform(0, config.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if config.error_rate > 0 and random.random() < config.error_rate:
+            self._send(500, "application/json", b'{"error": "stub injected error"}')
+            return
+
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+
+        if parsed.path.startswith("/v8/finance/chart/"):
+            symbol = unquote(parsed.path.rsplit("/", 1)[-1])
+            with_div = params.get("events", [""])[0] == "div"
+            payload = _chart_payload(symbol, with_div, config)
+            self._send(200, "application/json", json.dumps(payload).encode("utf-8"))
+        elif parsed.path == "/v1/finance/search":
+            symbol = params.get("q", [""])[0]
+            self._send(200, "application/json", json.dumps(_search_payload(symbol)).encode("utf-8"))
+        elif parsed.path == "/rss/search":
+            query = params.get("q", [""])[0]
+            self._send(200, "application/rss+xml; charset=utf-8", _rss_payload(query, config).encode("utf-8"))
+        else:
+            self._send(404, "application/json", b'{"error": "not found"}')
+
+    def _send(self, status: int, content_type: str, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # ベンチマーク中のアクセスログは抑制
+
+
+class StubServer:
+    """バックグラウンドスレッドで動くスタブサーバー"""
+
+    def __init__(self, config: StubConfig | None = None, host: str = "127.0.0.1", port: int = 0):
+        handler = type("StubHandler", (_StubHandler,), {"config": config or StubConfig()})
+        self._httpd = ThreadingHTTPServer((host, port), handler)
+        self._httpd.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Yahoo Finance / Google News スタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--payload-items", type=int, default=10)
+    parser.add_argument("--summary-chars", type=int, default=200)
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        payload_items=args.payload_items,
+        summary_chars=args.summary_chars,
+    )
+    server = StubServer(config, host=args.host, port=args.port)
+    print(f"スタブサーバー起動: {server.base_url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+証券会社の保有銘柄CSV（SBI証券・楽天証券形式など）を一括取り込みする。
+
+- リクエスト本文をチャンク単位で読みながら1行ずつ解析する（全体をメモリに載せない）
+- 文字コードは UTF-8（BOM付き含む）/ Shift_JIS(cp932) を自動判定
+- 先頭の口座情報などヘッダー以前の行は読み飛ばし、列名の別名から対応列を判定
+- 口座区分（特定・NISA など）ごとにヘッダー行が繰り返される形式に対応し、
+  同じ銘柄が複数の口座にあれば株数を合算して取得単価を加重平均する
+- 有効な行だけを対象に、株価・配当・セクターを並列でまとめて取得する
+"""
+
+import codecs
+import csv
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator
+
+from dividend_calendar import dividend_index
+from price_fetcher import fetch_stock_info
+from profiler import submit_traced
+
+IMPORT_MAX_ROWS = 2000  # 1回の取り込みで受け付ける最大行数
+ENRICH_MAX_WORKERS = 8  # Yahoo Finance APIへの負荷を考慮した並列数
+
+# 列名（括弧内の単位などを除去・小文字化した後）→ 項目名
+_COLUMN_ALIASES: dict[str, str] = {
+    "銘柄コード": "ticker",
+    "コード": "ticker",
+    "証券コード": "ticker",
+    "銘柄コード・ティッカー": "ticker",
+    "ticker": "ticker",
+    "銘柄": "name",
+    "銘柄名": "name",
+    "銘柄名称": "name",
+    "name": "name",
+    "銘柄(コード)": "ticker_name",
+    "保有株数": "shares",
+    "保有数量": "shares",
+    "数量": "shares",
+    "株数": "shares",
+    "shares": "shares",
+    "取得単価": "average_cost",
+    "平均取得価額": "average_cost",
+    "平均取得単価": "average_cost",
+    "取得価額": "average_cost",
+    "average_cost": "average_cost",
+    "現在値": "current_price",
+    "現在価格": "current_price",
+}
+
+# 列名末尾の単位表記（［株］・[円]・（円）など）
+_UNIT_SUFFIX = re.compile(r"[\[［(（][^\]］)）]*[\]］)）]$")
+# 国内株の銘柄コード（4桁、または 130A のような英字付き新コード）
+_TICKER_PATTERN = re.compile(r"^\d{3}[0-9A-Z]$")
+
+
+def _normalize_header(cell: str) -> str:
+    cell = cell.strip().replace("（", "(").replace("）", ")")
+    if cell not in _COLUMN_ALIASES:
+        cell = _UNIT_SUFFIX.sub("", cell).strip()
+    return cell.lower() if cell.isascii() else cell
+
+
+def _detect_columns(row: list[str]) -> dict[str, int] | None:
+    """ヘッダー行であれば 項目名 → 列番号 を返す。必要な列が揃っていなければ None。"""
+    columns: dict[str, int] = {}
+    for i, cell in enumerate(row):
+        key = _COLUMN_ALIASES.get(_normalize_header(cell))
+        if key and key not in columns:
+            columns[key] = i
+    has_ticker = "ticker" in columns or "ticker_name" in columns
+    if has_ticker and "shares" in columns and "average_cost" in columns:
+        return columns
+    return None
+
+
+def _parse_number(value: str) -> float | None:
+    cleaned = value.strip().replace(",", "").replace("株", "").replace("円", "").replace("口", "")
+    if cleaned in ("", "-", "--"):
+        return None
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+async def _decode_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """バイト列のチャンクを文字コード判定しながら1行ずつの文字列にする"""
+    decoder = None
+    buffer = ""
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        if decoder is None:
+            if chunk.isascii():
+                # ASCII の間はどちらの文字コードでも同じなので判定を保留する
+                buffer += chunk.decode("ascii")
+            else:
+                # 最初に非ASCIIを含むチャンクが UTF-8 として読めなければ Shift_JIS とみなす
+                try:
+                    codecs.getincrementaldecoder("utf-8-sig")().decode(chunk, final=False)
+                    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+                except UnicodeDecodeError:
+                    decoder = codecs.getincrementaldecoder("cp932")(errors="replace")
+        if decoder is not None:
+            buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    if decoder is not None:
+        buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def parse_holdings_csv(chunks: AsyncIterator[bytes]) -> tuple[list[dict], list[dict]]:
+    """
+    CSVを解析して (有効行, エラー行) を返す。
+
+    Returns:
+        有効行: {"row", "ticker", "name", "shares", "average_cost", "current_price", "merged_rows"} のリスト
+                （同じ銘柄の行は合算済み）
+        エラー行: {"row", "ticker", "status": "error", "message"} のリスト
+    """
+    valid: list[dict] = []
+    errors: list[dict] = []
+    columns: dict[str, int] | None = None
+    line_no = 0
+
+    async for line in _decode_lines(chunks):
+        line_no += 1
+        if not line.strip():
+            continue
+        row = next(csv.reader([line]))
+
+        # SBI証券などは口座区分ごとにヘッダー行が現れるため、毎行ヘッダーかどうかを判定する
+        header = _detect_columns(row)
+        if header is not None:
+            columns = header
+            continue
+        if columns is None:
+            continue  # ヘッダー以前の行（口座情報など）
+
+        if len(valid) + len(errors) >= IMPORT_MAX_ROWS:
+            errors.append({"row": line_no, "ticker": None, "status": "error",
+                           "message": f"取り込みは1回あたり{IMPORT_MAX_ROWS}行までです"})
+            break
+
+        def cell(key: str) -> str:
+            index = columns.get(key)
+            return row[index].strip() if index is not None and index < len(row) else ""
+
+        ticker, name = cell("ticker"), cell("name")
+        if not ticker and "ticker_name" in columns:
+            # 「7203 トヨタ自動車」のように銘柄コードと名称が1列にまとまっている形式
+            ticker, _, rest = cell("ticker_name").partition(" ")
+            name = name or rest.strip()
+        ticker = ticker.upper().removesuffix(".T")
+
+        # 合計行などの集計行は読み飛ばす
+        if not ticker or "合計" in ticker:
+            continue
+
+        shares = _parse_number(cell("shares"))
+        average_cost = _parse_number(cell("average_cost"))
+
+        # 「株式（現物/NISA預り）」のような口座区分の見出し行（数値列が空）も読み飛ばす
+        if not _TICKER_PATTERN.match(ticker) and shares is None and average_cost is None:
+            continue
+
+        message = None
+        if not _TICKER_PATTERN.match(ticker):
+            message = f"銘柄コード {ticker} は国内株式の形式ではありません"
+        elif shares is None or shares <= 0 or shares != int(shares):
+            message = "保有株数が正しくありません"
+        elif average_cost is None or average_cost < 0:
+            message = "取得単価が正しくありません"
+
+        if message:
+            errors.append({"row": line_no, "ticker": ticker, "status": "error", "message": message})
+            continue
+
+        valid.append({
+            "row": line_no,
+            "ticker": ticker,
+            "name": name,
+            "shares": int(shares),
+            "average_cost": average_cost,
+            "current_price": _parse_number(cell("current_price")),
+        })
+
+    if columns is None:
+        errors.append({"row": None, "ticker": None, "status": "error",
+                       "message": "ヘッダー行（銘柄コード・保有株数・取得単価）が見つかりません"})
+    return _merge_duplicates(valid), errors
+
+
+def _merge_duplicates(rows: list[dict]) -> list[dict]:
+    """
+    同じ銘柄の行（複数口座で保有している場合など）を1行にまとめる。
+    株数は合算、取得単価は株数で加重平均し、行番号は最初の行のものを使う。
+    まとめた行番号は merged_rows に入れる。
+    """
+    merged: dict[str, dict] = {}
+    for row in rows:
+        current = merged.get(row["ticker"])
+        if current is None:
+            merged[row["ticker"]] = {**row, "merged_rows": [row["row"]]}
+            continue
+        shares = current["shares"] + row["shares"]
+        current["average_cost"] = (
+            current["average_cost"] * current["shares"] + row["average_cost"] * row["shares"]
+        ) / shares
+        current["shares"] = shares
+        current["name"] = current["name"] or row["name"]
+        current["current_price"] = row["current_price"] or current["current_price"]
+        current["merged_rows"].append(row["row"])
+    return list(merged.values())
+
+
+def enrich_rows(rows: list[dict], record_events: bool = True) -> Iterator[tuple[dict, dict | None]]:
+    """
+    有効行ごとの銘柄情報を並列で取得し、(行, 銘柄情報 or None) を返す。
+    record_events=False なら配当イベントを索引に保存しない（dry_run 用）。
+    """
+    if not rows:
+        return
+    # 配当イベント索引は銘柄ごとに書き直さず、取り込み全体で1回だけ保存する
+    with dividend_index.deferred_save(), \
+            ThreadPoolExecutor(max_workers=min(len(rows), ENRICH_MAX_WORKERS)) as executor:
+        futures = [submit_traced(executor, fetch_stock_info, r["ticker"], record_events) for r in rows]
+        for row, future in zip(rows, futures):
+            try:
+                yield row, future.result()
+            except Exception as e:
+                print(f"銘柄情報取得エラー ({row['ticker']}): {e}")
+                yield row, None
+
+
+def build_holding(row: dict, info: dict | None) -> dict:
+    """CSVの行と取得した銘柄情報から保有銘柄レコードを組み立てる（CSV側の値を優先）"""
+    if info:
+        current_price = info["current_price"] or row["current_price"] or row["average_cost"]
+    else:
+        current_price = row["current_price"] or row["average_cost"]
+    return {
+        "ticker": row["ticker"],
+        "name": row["name"] or (info["name"] if info else row["ticker"]),
+        "shares": row["shares"],
+        "average_cost": row["average_cost"],
+        "current_price": current_price,
+        "market_value": current_price * row["shares"],
+        "annual_dividend_per_share": info["annual_dividend_per_share"] if info else 0.0,
+        "sector": info["sector"] if info else "その他",
+    }
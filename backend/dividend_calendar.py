@@ -0,0 +1,299 @@
+"""
+配当イベントの日付索引とカレンダー。
+
+- DividendEventIndex: Yahoo Finance の events=div で取得した権利落ち日ごとの配当（1株あたり）を
+  銘柄ごとに日付順で保持する。data/dividend_events.json（DIVIDEND_EVENTS_FILE で変更可）に保存し、
+  再起動後も使う。
+- DividendCalendar: 保有銘柄 × 配当イベント（実績 + 過去1年の実績を毎年繰り返した推定）を
+  日付順の配列と累積和・月別合計にまとめたもの。期間指定の問い合わせは bisect で答える。
+
+金額は /api/portfolio と同じく保有銘柄の annual_dividend_per_share（ユーザーが編集できる）を
+正とする。Yahoo Finance の実績は「いつ」「年間配当を各回にどう配分するか」にだけ使い、
+直近1年の実績合計が annual_dividend_per_share になるように各回の金額を比例配分する。
+
+日付は "YYYY-MM-DD" 形式の文字列のまま扱う（辞書順 = 日付順なので bisect がそのまま使える）。
+"""
+
+import bisect
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from itertools import accumulate
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+EVENTS_FILE = os.getenv("DIVIDEND_EVENTS_FILE", os.path.join(DATA_DIR, "dividend_events.json"))
+
+JST = timezone(timedelta(hours=9))
+
+# 実績のない銘柄に使う従来の推定日（3月・9月権利確定）
+# (権利確定の月日, 入金の月日, 入金が翌年なら1, 備考)
+_DEFAULT_PATTERN = [
+    ("03-30", "06-01", 0, "期末配当（自動推定）"),
+    ("09-28", "12-01", 0, "中間配当（自動推定）"),
+]
+
+
+def _shift_year(iso: str, years: int) -> str:
+    """日付を years 年ずらす（2/29 は 2/28 に丸める）"""
+    y, m, d = int(iso[:4]) + years, int(iso[5:7]), int(iso[8:10])
+    try:
+        return date(y, m, d).isoformat()
+    except ValueError:
+        return date(y, m, 28).isoformat()
+
+
+def _estimate_payment_date(ex_date: str) -> str:
+    """権利確定月の3ヶ月後の1日を入金日の目安とする（国内株の一般的な支払時期）"""
+    y, m = int(ex_date[:4]), int(ex_date[5:7]) + 3
+    if m > 12:
+        y, m = y + 1, m - 12
+    return f"{y:04d}-{m:02d}-01"
+
+
+class DividendEventIndex:
+    """銘柄ごとの配当イベント（権利落ち日, 1株あたり配当）を日付順に保持する"""
+
+    def __init__(self, path: str = EVENTS_FILE):
+        self._path = path
+        self._events: dict[str, list[tuple[str, float]]] = {}
+        self._lock = threading.Lock()
+        self._deferred = 0  # deferred_save() の入れ子数（全スレッド共通）
+        self._dirty = False
+        self.version = 0
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            self._events = {t: sorted((d, float(a)) for d, a in events) for t, events in raw.items()}
+        except Exception as e:
+            print(f"配当イベント読み込みエラー: {e}")
+
+    def _save(self) -> None:
+        self._dirty = False
+        tmp_path = f"{self._path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._events, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path)
+        except Exception as e:
+            print(f"配当イベント保存エラー: {e}")
+
+    def update(self, ticker: str, raw_events: dict) -> None:
+        """Yahoo Finance の events.dividends（{"<ts>": {"amount", "date"}}）を取り込む"""
+        incoming = {
+            datetime.fromtimestamp(v["date"], tz=JST).date().isoformat(): float(v["amount"])
+            for v in raw_events.values()
+        }
+        with self._lock:
+            merged = dict(self._events.get(ticker, []))
+            merged.update(incoming)
+            events = sorted(merged.items())
+            if events == self._events.get(ticker):
+                return
+            self._events[ticker] = events
+            self.version += 1
+            self._dirty = True
+            if not self._deferred:
+                self._save()
+
+    @contextmanager
+    def deferred_save(self):
+        """
+        ブロック内の更新はファイルに書かず、最後のブロックを抜けるときに1回だけ保存する。
+        全銘柄のリフレッシュなどで銘柄ごとにファイル全体を書き直さないために使う。
+        """
+        with self._lock:
+            self._deferred += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._deferred -= 1
+                if not self._deferred and self._dirty:
+                    self._save()
+
+    def events(self, ticker: str) -> list[tuple[str, float]]:
+        return self._events.get(ticker, [])
+
+
+class DividendCalendar:
+    """保有銘柄の配当イベントを日付順に並べ、期間集計を bisect と累積和で行う"""
+
+    def __init__(self, holdings: list[dict], index: DividendEventIndex, static_schedule: list[dict],
+                 first_year: int, last_year: int):
+        self.first_year = first_year
+        self.last_year = last_year
+        horizon = f"{last_year}-12-31"
+
+        static_by_ticker: dict[str, list[dict]] = {}
+        for month_data in static_schedule:
+            for e in month_data.get("entries", []):
+                static_by_ticker.setdefault(e["ticker"], []).append(e)
+
+        entries: list[dict] = []
+        for h in holdings:
+            events = index.events(h["ticker"])
+            if events:
+                entries.extend(self._from_events(h, events, horizon))
+            elif h["ticker"] in static_by_ticker:
+                pattern = []
+                for e in static_by_ticker[h["ticker"]]:
+                    payment = e.get("payment_date")
+                    pattern.append((
+                        e["ex_date"][5:],
+                        payment[5:] if payment else None,
+                        int(payment[:4]) - int(e["ex_date"][:4]) if payment else 0,
+                        e.get("note", ""),
+                    ))
+                entries.extend(self._from_pattern(h, pattern, "static"))
+            elif h.get("annual_dividend_per_share", 0) > 0:
+                entries.extend(self._from_pattern(h, _DEFAULT_PATTERN, "estimated"))
+
+        entries.sort(key=lambda e: (e["ex_date"], e["ticker"]))
+        self._entries = entries
+        self._dates = [e["ex_date"] for e in entries]
+        self._prefix = [0, *accumulate(e["amount"] for e in entries)]
+
+        # 月別合計（"YYYY-MM" → 金額）を前計算しておく
+        self._monthly: dict[str, int] = {}
+        for e in entries:
+            key = e["ex_date"][:7]
+            self._monthly[key] = self._monthly.get(key, 0) + e["amount"]
+
+    def _from_events(self, h: dict, events: list[tuple[str, float]], horizon: str) -> list[dict]:
+        """実績イベント + 直近1年の実績を毎年繰り返した将来分の推定"""
+        # 直近の実績から遡って約11ヶ月以内を1年分の配当パターンとみなす
+        # （ちょうど1年前の同じ回の配当を含めると、翌年分と重複するため）
+        last = events[-1][0]
+        cutoff = (date.fromisoformat(last) - timedelta(days=335)).isoformat()
+        pattern = [(d, a) for d, a in events if d > cutoff]
+
+        # 1年分の実績合計が保有銘柄の年間配当と一致するよう、各回の金額を比例配分する
+        pattern_total = sum(a for _, a in pattern)
+        annual = h.get("annual_dividend_per_share", 0)
+        if annual <= 0 or pattern_total <= 0:
+            return []
+        scale = annual / pattern_total
+
+        out = []
+        for ex_date, per_share in events:
+            out.append(self._entry(h, ex_date, per_share * scale, "yahoo", projected=False,
+                                   note="配当実績（Yahoo Finance）"))
+
+        years = 1
+        while True:
+            added = False
+            for ex_date, per_share in pattern:
+                projected = _shift_year(ex_date, years)
+                if projected > horizon or projected <= last:
+                    continue
+                added = True
+                out.append(self._entry(h, projected, per_share * scale, "yahoo", projected=True,
+                                       note="配当予想（過去1年の実績から推定）"))
+            if not added:
+                break
+            years += 1
+        return out
+
+    def _from_pattern(self, h: dict, pattern: list[tuple], source: str) -> list[dict]:
+        """月日だけが分かっている銘柄は、年間配当を回数で割って毎年同じ時期に配置する"""
+        per_share = h.get("annual_dividend_per_share", 0) / len(pattern)
+        out = []
+        for year in range(self.first_year, self.last_year + 1):
+            for month_day, payment_month_day, payment_year_delta, note in pattern:
+                ex_date = _shift_year(f"{year}-{month_day}", 0)
+                payment = None
+                if payment_month_day:
+                    payment = _shift_year(f"{year + payment_year_delta}-{payment_month_day}", 0)
+                out.append(self._entry(h, ex_date, per_share, source, projected=True, note=note, payment_date=payment))
+        return out
+
+    @staticmethod
+    def _entry(h: dict, ex_date: str, per_share: float, source: str, projected: bool,
+               note: str, payment_date: str | None = None) -> dict:
+        return {
+            "ticker": h["ticker"],
+            "name": h["name"],
+            "ex_date": ex_date,
+            "payment_date": payment_date or _estimate_payment_date(ex_date),
+            "amount_per_share": per_share,
+            "amount": int(per_share * h["shares"]),
+            "projected": projected,
+            "source": source,
+            "note": note,
+        }
+
+    def query(self, start: date, end: date) -> dict:
+        """期間内のイベント一覧・合計・月別合計を返す"""
+        lo = bisect.bisect_left(self._dates, start.isoformat())
+        hi = bisect.bisect_right(self._dates, end.isoformat())
+
+        months = []
+        y, m = start.year, start.month
+        while (y, m) <= (end.year, end.month):
+            key = f"{y:04d}-{m:02d}"
+            if (y, m) in ((start.year, start.month), (end.year, end.month)):
+                # 期間の端の月は一部だけが対象なので累積和から求める
+                month_lo = max(lo, bisect.bisect_left(self._dates, f"{key}-01"))
+                month_hi = min(hi, bisect.bisect_right(self._dates, f"{key}-31"))
+                total = self._prefix[month_hi] - self._prefix[month_lo] if month_hi > month_lo else 0
+            else:
+                total = self._monthly.get(key, 0)
+            months.append({"month": key, "total": total})
+            y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+
+        return {
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "total": self._prefix[hi] - self._prefix[lo],
+            "months": months,
+            "entries": self._entries[lo:hi],
+        }
+
+
+# アプリ全体で共有する配当イベント索引
+dividend_index = DividendEventIndex()
+
+CALENDAR_CACHE_SIZE = int(os.getenv("DIVIDEND_CALENDAR_CACHE_SIZE", "64"))
+
+# uid -> (キー, カレンダー)。古いものから追い出す
+_calendar_cache: OrderedDict[str | None, tuple[tuple, DividendCalendar]] = OrderedDict()
+_calendar_lock = threading.Lock()
+
+
+def get_calendar(uid: str | None, holdings: list[dict], static_schedule: list[dict],
+                 first_year: int, last_year: int) -> DividendCalendar:
+    """
+    ユーザーのカレンダーを返す。保有銘柄・配当イベント・対象年が前回と同じなら組み立て済みのものを
+    再利用し、リクエストごとに全保有銘柄を走査し直さない。
+    ユーザーごとに保持するので、複数ユーザーが交互に呼んでも作り直しにならない。組み立てはロックの外で
+    行い、あるユーザーの再構築が他のユーザーのリクエストを待たせないようにする。
+    """
+    key = (
+        dividend_index.version,
+        first_year,
+        last_year,
+        tuple((h["ticker"], h["name"], h["shares"], h.get("annual_dividend_per_share", 0)) for h in holdings),
+        tuple((e["ticker"], e["ex_date"], e.get("payment_date"), e.get("note"))
+              for m in static_schedule for e in m.get("entries", [])),
+    )
+    with _calendar_lock:
+        cached = _calendar_cache.get(uid)
+        if cached is not None and cached[0] == key:
+            _calendar_cache.move_to_end(uid)
+            return cached[1]
+
+    calendar = DividendCalendar(holdings, dividend_index, static_schedule, first_year, last_year)
+    with _calendar_lock:
+        _calendar_cache[uid] = (key, calendar)
+        _calendar_cache.move_to_end(uid)
+        while len(_calendar_cache) > CALENDAR_CACHE_SIZE:
+            _calendar_cache.popitem(last=False)
+    return calendar
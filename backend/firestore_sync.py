@@ -0,0 +1,216 @@
+"""
+Firestore への保有銘柄書き込みを非同期化する write-behind キュー。
+
+- 追加・更新・削除を users/{uid}/holdings/{ticker} 単位で溜め、同じ銘柄への連続した
+  書き込みは最後の1件にまとめる（coalesce）
+- バックグラウンドスレッドが一定間隔で Firestore のバッチ書き込み（最大500件）で反映する
+- 失敗時は指数バックオフで再試行する
+- 未反映の変更はローカルのジャーナル（JSONL）に追記しておき、再起動時に読み戻す
+
+環境変数:
+    FIRESTORE_FLUSH_INTERVAL  反映間隔（秒、既定 2）
+    FIRESTORE_JOURNAL_FILE    ジャーナルの保存先（既定 data/firestore_journal.jsonl）
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from typing import Callable
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+JOURNAL_FILE = os.getenv("FIRESTORE_JOURNAL_FILE", os.path.join(DATA_DIR, "firestore_journal.jsonl"))
+FLUSH_INTERVAL_SECONDS = float(os.getenv("FIRESTORE_FLUSH_INTERVAL", "2"))
+
+BATCH_LIMIT = 500          # Firestore のバッチ書き込み上限
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+
+def _default_client():
+    from firebase_config import get_firestore_client
+    return get_firestore_client()
+
+
+class FirestoreWriteBehind:
+    """保有銘柄の変更を溜めて Firestore へまとめて反映するキュー"""
+
+    def __init__(
+        self,
+        client_factory: Callable = _default_client,
+        journal_file: str = JOURNAL_FILE,
+        flush_interval: float = FLUSH_INTERVAL_SECONDS,
+    ):
+        self._client_factory = client_factory
+        self._journal_file = journal_file
+        self._flush_interval = flush_interval
+        # (uid, ticker) → {"op": "set" | "delete", "data": dict | None, "seq": int}
+        self._pending: dict[tuple[str, str], dict] = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+        # ジャーナルのファイル操作専用。fsync 中もキュー（_lock）は塞がない
+        self._journal_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._failures = 0
+
+    # ---------- 変更の登録 ----------
+
+    def enqueue_set(self, uid: str, ticker: str, data: dict) -> None:
+        self._enqueue(uid, ticker, {"op": "set", "data": data})
+
+    def enqueue_delete(self, uid: str, ticker: str) -> None:
+        self._enqueue(uid, ticker, {"op": "delete", "data": None})
+
+    def enqueue_many(self, uid: str, holdings: list[dict]) -> None:
+        """複数銘柄の追加・更新をまとめて登録する（ジャーナルの fsync は1回。一括取り込み用）"""
+        self._enqueue_all([(uid, h["ticker"], {"op": "set", "data": h}) for h in holdings])
+
+    def _enqueue(self, uid: str, ticker: str, entry: dict) -> None:
+        self._enqueue_all([(uid, ticker, entry)])
+
+    def _enqueue_all(self, items: list[tuple[str, str, dict]]) -> None:
+        if not items:
+            return
+        with self._lock:
+            for uid, ticker, entry in items:
+                self._seq += 1
+                entry["seq"] = self._seq
+                self._pending[(uid, ticker)] = entry
+            if len(self._pending) >= BATCH_LIMIT:
+                self._wakeup.set()
+        # キューへの登録後に追記する。書き直しと前後しても、書き直しの内容に含まれるか
+        # 書き直し後のファイルに追記されるかのどちらかになる（順序は seq で復元する）
+        self._append_journal([{"uid": uid, "ticker": ticker, **entry} for uid, ticker, entry in items])
+        self._ensure_started()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    # ---------- ジャーナル ----------
+
+    def _append_journal(self, records: list[dict]) -> None:
+        try:
+            with self._journal_lock:
+                os.makedirs(os.path.dirname(self._journal_file), exist_ok=True)
+                with open(self._journal_file, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception as e:
+            print(f"Firestoreジャーナル書き込みエラー: {e}")
+
+    def _rewrite_journal(self) -> None:
+        """未反映分だけを残してジャーナルを書き直す"""
+        tmp_path = f"{self._journal_file}.tmp"
+        try:
+            with self._journal_lock:
+                with self._lock:
+                    pending = list(self._pending.items())
+                os.makedirs(os.path.dirname(self._journal_file), exist_ok=True)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for (uid, ticker), entry in pending:
+                        f.write(json.dumps({"uid": uid, "ticker": ticker, **entry}, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self._journal_file)
+        except Exception as e:
+            print(f"Firestoreジャーナル書き直しエラー: {e}")
+
+    def recover(self) -> int:
+        """起動時にジャーナルから未反映の変更を読み戻す。読み戻した件数を返す。"""
+        if not os.path.exists(self._journal_file):
+            return 0
+        recovered: dict[tuple[str, str], dict] = {}
+        with open(self._journal_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 書き込み途中で落ちた最終行は捨てる
+                key = (record["uid"], record["ticker"])
+                seq = record.get("seq", 0)
+                # 追記順と登録順は前後しうるので、同じ銘柄は seq が最大のものを採用する
+                if key not in recovered or seq >= recovered[key]["seq"]:
+                    recovered[key] = {"op": record["op"], "data": record["data"], "seq": seq}
+        with self._lock:
+            # 起動後に登録された変更の方が新しいので優先する
+            for key, entry in recovered.items():
+                self._pending.setdefault(key, entry)
+            self._seq = max([self._seq, *(e["seq"] for e in recovered.values())])
+        self._rewrite_journal()
+        if recovered:
+            print(f"Firestoreジャーナルから{len(recovered)}件を復元しました")
+            self._ensure_started()
+        return len(recovered)
+
+    # ---------- 反映 ----------
+
+    def flush(self) -> bool:
+        """溜まっている変更を Firestore へ反映する。成功（または変更なし）なら True。"""
+        with self._lock:
+            snapshot = dict(self._pending)
+        if not snapshot:
+            return True
+
+        try:
+            db = self._client_factory()
+            if db is None:
+                raise RuntimeError("Firestore クライアントを取得できません")
+            items = list(snapshot.items())
+            for i in range(0, len(items), BATCH_LIMIT):
+                batch = db.batch()
+                for (uid, ticker), entry in items[i:i + BATCH_LIMIT]:
+                    ref = db.collection("users").document(uid).collection("holdings").document(ticker)
+                    if entry["op"] == "delete":
+                        batch.delete(ref)
+                    else:
+                        batch.set(ref, entry["data"])
+                batch.commit()
+                # コミット済みの分は、その間に新しい変更が来ていなければキューから外す
+                with self._lock:
+                    for key, entry in items[i:i + BATCH_LIMIT]:
+                        if self._pending.get(key) is entry:
+                            del self._pending[key]
+                self._rewrite_journal()
+        except Exception as e:
+            print(f"Firestore反映エラー（再試行します）: {e}")
+            return False
+        return True
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            if self._failures:
+                delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (self._failures - 1))
+                delay *= random.uniform(0.5, 1.0)
+            else:
+                delay = self._flush_interval
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            self._failures = 0 if self.flush() else self._failures + 1
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None or self._stopping.is_set():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="firestore-write-behind", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """停止前に残りを反映する。反映できなかった分はジャーナルに残り次回起動時に再送される。"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        deadline = time.time() + timeout
+        while self.pending_count() and time.time() < deadline:
+            if not self.flush():
+                break
+
+
+# アプリ全体で共有するキュー
+write_behind = FirestoreWriteBehind()
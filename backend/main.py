@@ -10,8 +10,12 @@
 
 import json
 import os
-from fastapi import FastAPI, Query, HTTPException, Header, Depends
+from contextlib import asynccontextmanager
+from datetime import date
+from fastapi import FastAPI, Query, HTTPException, Header, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
 
@@ -23,13 +27,34 @@ except ImportError:
     pass
 
 from price_fetcher import fetch_prices, fetch_stock_info, get_cache_updated_at, _fetch_annual_dividend, to_yahoo_symbol
-from news_fetcher import fetch_all_news, fetch_news_for_ticker
+from news_fetcher import build_matcher, fetch_all_news, fetch_news_for_ticker
+from csv_importer import parse_holdings_csv, enrich_rows, build_holding
+from profiler import ProfiledRoute, ProfilingMiddleware, list_profiles, load_profile, require_profile_admin, span
+from firestore_sync import write_behind
+from dividend_calendar import dividend_index, get_calendar
+from portfolio_store import PortfolioLoadError, portfolio_store, price_warmer
+from price_stream import TOKEN_TTL_SECONDS, broadcaster, issue_stream_token, verify_stream_token
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 前回終了時に Firestore へ反映しきれなかった変更を再送する
+    write_behind.recover()
+    # メモリ上のポートフォリオの銘柄（和集合）の株価をキャッシュ切れ前に取得し直す
+    price_warmer.start()
+    yield
+    price_warmer.stop()
+    write_behind.stop()
+
 
 app = FastAPI(
     title="配当管理アプリ API",
     description="シニア投資家向け配当管理・ニュース集約アプリのバックエンド (MVP)",
     version="0.2.0",
+    lifespan=lifespan,
 )
+# エンドポイント関数の実行時間をプロファイルに記録する（計測対象外のリクエストでは何もしない）
+app.router.route_class = ProfiledRoute
 
 # Firebase初期化
 from firebase_config import initialize_firebase, verify_token
@@ -78,31 +103,36 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# リクエスト単位のプロファイリング（X-Profile-Token ヘッダー指定時、または抽選時のみ）
+app.add_middleware(ProfilingMiddleware)
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
-STOCKS_FILE = os.path.join(DATA_DIR, "stocks.json")
 DIVIDENDS_FILE = os.path.join(DATA_DIR, "dividends.json")
 
 
 # ---------- ユーティリティ ----------
 
 def load_json(filepath: str) -> dict:
-    with open(filepath, "r", encoding="utf-8") as f:
+    with span("storage_load"), open(filepath, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
-def save_json(filepath: str, data: dict) -> None:
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def user_id(user: dict | None) -> str | None:
+    """ポートフォリオの保存先を決める uid（未認証の開発環境では None = 共有ポートフォリオ）"""
+    return user["uid"] if user else None
 
 
-def get_holdings() -> list[dict]:
-    return load_json(STOCKS_FILE).get("holdings", [])
+def get_holdings(uid: str | None = None) -> list[dict]:
+    try:
+        return portfolio_store.get(uid)
+    except PortfolioLoadError as e:
+        # 空のポートフォリオとして続行すると、次の保存で既存の保有銘柄を上書きしてしまう
+        print(f"ポートフォリオ読み込みエラー: {e}")
+        raise HTTPException(status_code=503, detail="ポートフォリオを読み込めませんでした。時間をおいて再度お試しください")
 
 
-def save_holdings(holdings: list[dict]) -> None:
-    data = load_json(STOCKS_FILE)
-    data["holdings"] = holdings
-    save_json(STOCKS_FILE, data)
+def save_holdings(holdings: list[dict], uid: str | None = None) -> None:
+    portfolio_store.save(uid, holdings)
 
 
 # ---------- Pydanticモデル ----------
@@ -129,7 +159,7 @@ class HoldingUpdate(BaseModel):
 @app.get("/health")
 def health_check():
     """サーバーが正常に動作しているかを確認する"""
-    return {"status": "ok", "version": app.version}
+    return {"status": "ok", "version": app.version, "portfolios": portfolio_store.stats()}
 
 
 # ---------- ポートフォリオ ----------
@@ -140,7 +170,7 @@ def get_portfolio(user: dict | None = Depends(get_current_user)):
     保有資産のポートフォリオ情報を返す。
     Yahoo Finance APIで現在値を取得（5分キャッシュ）。
     """
-    holdings = get_holdings()
+    holdings = get_holdings(user_id(user))
     tickers = [h["ticker"] for h in holdings]
 
     prices = fetch_prices(tickers)
@@ -172,24 +202,23 @@ def get_portfolio(user: dict | None = Depends(get_current_user)):
 @app.post("/api/portfolio/refresh")
 def refresh_prices(user: dict | None = Depends(get_current_user)):
     """全銘柄の株価・配当を強制的にYahoo Financeから再取得する"""
-    from price_fetcher import CACHE_FILE
-    if os.path.exists(CACHE_FILE):
-        os.remove(CACHE_FILE)
-
-    holdings = get_holdings()
+    uid = user_id(user)
+    holdings = get_holdings(uid)
     tickers = [h["ticker"] for h in holdings]
-    prices = fetch_prices(tickers)
+    # 他のユーザーと共有しているキャッシュは消さず、自分の銘柄だけを取得し直す
+    prices = fetch_prices(tickers, max_age=0)
 
-    # 配当も更新
+    # 配当も更新（配当イベント索引の保存は最後に1回だけ行う）
     dividend_updated = []
-    for h in holdings:
-        symbol = to_yahoo_symbol(h["ticker"])
-        new_dividend = _fetch_annual_dividend(symbol)
-        if new_dividend > 0 and new_dividend != h.get("annual_dividend_per_share", 0):
-            h["annual_dividend_per_share"] = new_dividend
-            dividend_updated.append(h["ticker"])
+    with dividend_index.deferred_save():
+        for h in holdings:
+            symbol = to_yahoo_symbol(h["ticker"])
+            new_dividend = _fetch_annual_dividend(symbol)
+            if new_dividend > 0 and new_dividend != h.get("annual_dividend_per_share", 0):
+                h["annual_dividend_per_share"] = new_dividend
+                dividend_updated.append(h["ticker"])
     if dividend_updated:
-        save_holdings(holdings)
+        save_holdings(holdings, uid)
 
     return {
         "message": "価格と配当を更新しました",
@@ -206,8 +235,8 @@ def add_holding(
     body: HoldingCreate,
     user: dict | None = Depends(get_current_user),
 ):
-    """保有銘柄を新規追加する。認証済みの場合はFirestoreにも保存。"""
-    holdings = get_holdings()
+    """保有銘柄を新規追加する。認証済みの場合はFirestoreにも保存（非同期）。"""
+    holdings = get_holdings(user_id(user))
 
     if any(h["ticker"] == body.ticker for h in holdings):
         raise HTTPException(status_code=409, detail=f"銘柄コード {body.ticker} はすでに登録されています")
@@ -227,27 +256,95 @@ def add_holding(
     }
 
     holdings.append(new_holding)
-    save_holdings(holdings)
+    save_holdings(holdings, user_id(user))
 
-    # Firestoreへの保存（認証済みの場合）
+    # Firestoreへの保存（認証済みの場合、バックグラウンドでまとめて反映）
     if user:
-        try:
-            from firebase_config import get_firestore_client
-            uid = user["uid"]
-            db = get_firestore_client()
-            if db:
-                db.collection("users").document(uid).collection("holdings").document(body.ticker).set(new_holding)
-                print(f"Firestore保存完了: users/{uid}/holdings/{body.ticker}")
-        except Exception as e:
-            print(f"Firestore保存エラー（処理は続行）: {e}")
+        write_behind.enqueue_set(user["uid"], body.ticker, new_holding)
 
     return new_holding
 
 
+@app.post("/api/portfolio/holdings/import")
+async def import_holdings(
+    request: Request,
+    dry_run: bool = Query(default=False, description="検証のみ行い保存しない"),
+    user: dict | None = Depends(get_current_user),
+):
+    """
+    証券会社の保有銘柄CSV（SBI証券・楽天証券形式など）を一括で取り込む。
+    リクエスト本文にCSVをそのまま送る（Content-Type: text/csv）。
+    株価・配当・セクターはまとめて並列取得し、保存は最後に1回だけ行う。
+    """
+    valid_rows, results = await parse_holdings_csv(request.stream())
+
+    # 既存銘柄との重複を除外（ファイル内の重複は parse_holdings_csv で合算済み）
+    existing = {h["ticker"] for h in await run_in_threadpool(get_holdings, user_id(user))}
+    targets = []
+    for row in valid_rows:
+        if row["ticker"] in existing:
+            results.append({"row": row["row"], "ticker": row["ticker"], "status": "skipped",
+                            "message": f"銘柄コード {row['ticker']} はすでに登録されています"})
+            continue
+        targets.append(row)
+
+    new_holdings = []
+    added_results = []
+    enriched = await run_in_threadpool(lambda: list(enrich_rows(targets, record_events=not dry_run)))
+    for row, info in enriched:
+        holding = build_holding(row, info)
+        new_holdings.append(holding)
+        messages = []
+        if len(row["merged_rows"]) > 1:
+            messages.append(f"{', '.join(map(str, row['merged_rows']))}行目を合算しました")
+        if not info:
+            messages.append("銘柄情報を取得できなかったため取得単価を現在値として登録しました")
+        added_results.append({
+            "row": row["row"],
+            "ticker": row["ticker"],
+            "status": "added",
+            "message": " / ".join(messages) or None,
+            "holding": holding,
+        })
+
+    if new_holdings and not dry_run:
+        def _commit() -> list[dict]:
+            # 取得処理中に単体追加された銘柄があれば、そちらを優先して二重登録を防ぐ
+            holdings = get_holdings(user_id(user))
+            current = {h["ticker"] for h in holdings}
+            appended = [h for h in new_holdings if h["ticker"] not in current]
+            holdings.extend(appended)
+            save_holdings(holdings, user_id(user))
+            return appended
+        appended = await run_in_threadpool(_commit)
+
+        # 実際に保存できなかった銘柄は Firestore にも送らず、スキップとして報告する
+        appended_tickers = {h["ticker"] for h in appended}
+        for r in added_results:
+            if r["ticker"] not in appended_tickers:
+                r.update(status="skipped", holding=None,
+                         message=f"銘柄コード {r['ticker']} は取り込み中に登録されました")
+        new_holdings = appended
+
+        if user:
+            # ジャーナルの書き込み（fsync）をイベントループ上で行わないようにする
+            await run_in_threadpool(write_behind.enqueue_many, user["uid"], new_holdings)
+
+    results.extend(added_results)
+    results.sort(key=lambda r: r["row"] or 0)
+    return {
+        "dry_run": dry_run,
+        "added": len(new_holdings),
+        "skipped": sum(1 for r in results if r["status"] == "skipped"),
+        "errors": sum(1 for r in results if r["status"] == "error"),
+        "results": results,
+    }
+
+
 @app.put("/api/portfolio/holdings/{ticker}")
 def update_holding(ticker: str, body: HoldingUpdate, user: dict | None = Depends(get_current_user)):
     """既存の保有銘柄を更新する"""
-    holdings = get_holdings()
+    holdings = get_holdings(user_id(user))
     for h in holdings:
         if h["ticker"] == ticker:
             if body.name is not None:
@@ -260,7 +357,9 @@ def update_holding(ticker: str, body: HoldingUpdate, user: dict | None = Depends
                 h["annual_dividend_per_share"] = body.annual_dividend_per_share
             if body.sector is not None:
                 h["sector"] = body.sector
-            save_holdings(holdings)
+            save_holdings(holdings, user_id(user))
+            if user:
+                write_behind.enqueue_set(user["uid"], ticker, h)
             return h
     raise HTTPException(status_code=404, detail=f"銘柄コード {ticker} が見つかりません")
 
@@ -268,11 +367,13 @@ def update_holding(ticker: str, body: HoldingUpdate, user: dict | None = Depends
 @app.delete("/api/portfolio/holdings/{ticker}", status_code=204)
 def delete_holding(ticker: str, user: dict | None = Depends(get_current_user)):
     """保有銘柄を削除する"""
-    holdings = get_holdings()
+    holdings = get_holdings(user_id(user))
     new_holdings = [h for h in holdings if h["ticker"] != ticker]
     if len(new_holdings) == len(holdings):
         raise HTTPException(status_code=404, detail=f"銘柄コード {ticker} が見つかりません")
-    save_holdings(new_holdings)
+    save_holdings(new_holdings, user_id(user))
+    if user:
+        write_behind.enqueue_delete(user["uid"], ticker)
     return None
 
 
@@ -285,15 +386,67 @@ def get_stock_info(ticker: str, user: dict | None = Depends(get_current_user)):
     return info
 
 
+# ---------- 株価のプッシュ配信 ----------
+
+def get_stream_user(
+    token: str | None = Query(default=None, description="/api/stream/token で発行した接続用トークン"),
+    authorization: Optional[str] = Header(default=None),
+) -> dict | None:
+    """
+    配信用の認証。EventSource はヘッダーを付けられないため、クエリの短命トークンも受け付ける。
+    トークンがなければ通常どおり Authorization ヘッダーで認証する（fetch でストリームを読む場合）。
+    """
+    import firebase_admin
+    if not firebase_admin._apps:
+        return None
+    if token:
+        uid = verify_stream_token(token)
+        if not uid:
+            raise HTTPException(status_code=401, detail="接続用トークンが無効か期限切れです")
+        return {"uid": uid}
+    return get_current_user(authorization)
+
+
+@app.post("/api/stream/token")
+def create_stream_token(user: dict | None = Depends(get_current_user)):
+    """/api/stream/prices への接続用トークンを発行する（Firebase未設定時は不要なので null）"""
+    if not user:
+        return {"token": None, "expires_in": None}
+    return {"token": issue_stream_token(user["uid"]), "expires_in": TOKEN_TTL_SECONDS}
+
+
+@app.get("/api/stream/prices")
+async def stream_prices(
+    tickers: str | None = Query(default=None, description="購読する銘柄コード（カンマ区切り、省略時は全保有銘柄）"),
+    user: dict | None = Depends(get_stream_user),
+):
+    """
+    保有銘柄の株価を Server-Sent Events で配信する。
+    サーバー側の1つのポーラーが全接続分をまとめて取得し、変化した銘柄だけを送る。
+    ブラウザからは POST /api/stream/token で取得したトークンを ?token= に付けて EventSource で接続する。
+    """
+    held = [h["ticker"] for h in await run_in_threadpool(get_holdings, user_id(user))]
+    if tickers:
+        requested = {t.strip() for t in tickers.split(",") if t.strip()}
+        targets = [t for t in held if t in requested]
+    else:
+        targets = held
+
+    return StreamingResponse(
+        broadcaster.stream(targets),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ---------- 配当スケジュール ----------
 
 @app.get("/api/dividends")
 def get_dividends(user: dict | None = Depends(get_current_user)):
     """月別の配当金入金スケジュールを返す（保有銘柄に基づいて金額を動的に計算）"""
-    from datetime import date
-
     data = load_json(DIVIDENDS_FILE)
-    holdings = get_holdings()
+    uid = user_id(user)
+    holdings = get_holdings(uid)
 
     # 銘柄ごとのHoldingオブジェクトをマップ化
     holdings_map = {h["ticker"]: h for h in holdings}
@@ -323,35 +476,20 @@ def get_dividends(user: dict | None = Depends(get_current_user)):
                 new_entry["amount"] = amount
                 schedule_map[month_data["month"]].append(new_entry)
 
-    # 2) 静的スケジュールにない銘柄 → 3月・9月のデフォルトスケジュールを自動生成
+    # 2) 静的スケジュールにない銘柄 → 配当カレンダー（Yahoo Finance の実績・予想、
+    #    実績がなければ3月・9月のデフォルトスケジュール）から今年分を配置
     year = date.today().year
-    for h in holdings:
-        ticker = h["ticker"]
-        if ticker in tickers_in_schedule:
+    calendar = get_calendar(uid, holdings, data.get("schedule", []), year - 2, year + 2)
+    for e in calendar.query(date(year, 1, 1), date(year, 12, 31))["entries"]:
+        if e["ticker"] in tickers_in_schedule:
             continue
-        annual_div = h.get("annual_dividend_per_share", 0)
-        if annual_div <= 0:
-            continue
-        total_div = h["shares"] * annual_div
-        amount_per_payment = int(total_div / 2)
-
-        # 3月権利確定 → 6月入金
-        schedule_map[3].append({
-            "ticker": ticker,
-            "name": h["name"],
-            "amount": amount_per_payment,
-            "ex_date": f"{year}-03-30",
-            "payment_date": f"{year}-06-01",
-            "note": "期末配当（自動推定）",
-        })
-        # 9月権利確定 → 12月入金
-        schedule_map[9].append({
-            "ticker": ticker,
-            "name": h["name"],
-            "amount": amount_per_payment,
-            "ex_date": f"{year}-09-28",
-            "payment_date": f"{year}-12-01",
-            "note": "中間配当（自動推定）",
+        schedule_map[int(e["ex_date"][5:7])].append({
+            "ticker": e["ticker"],
+            "name": e["name"],
+            "amount": e["amount"],
+            "ex_date": e["ex_date"],
+            "payment_date": e["payment_date"],
+            "note": e["note"],
         })
 
     # 年間合計を計算
@@ -373,6 +511,36 @@ def get_dividends(user: dict | None = Depends(get_current_user)):
     }
 
 
+@app.get("/api/dividends/calendar")
+def get_dividend_calendar(
+    from_: date | None = Query(default=None, alias="from", description="開始日（YYYY-MM-DD、省略時は今年の1月1日）"),
+    to: date | None = Query(default=None, description="終了日（YYYY-MM-DD、省略時は今年の12月31日）"),
+    user: dict | None = Depends(get_current_user),
+):
+    """
+    指定期間の配当イベント（権利確定日ベース）と月別合計を返す。
+    Yahoo Finance の配当実績と、直近1年の実績を繰り返した将来予想を含む（複数年可）。
+    """
+    today = date.today()
+    start = from_ or date(today.year, 1, 1)
+    end = to or date(today.year, 12, 31)
+    if end < start:
+        raise HTTPException(status_code=400, detail="終了日は開始日以降を指定してください")
+    if end.year - start.year > 10:
+        raise HTTPException(status_code=400, detail="期間は10年以内で指定してください")
+
+    uid = user_id(user)
+    holdings = get_holdings(uid)
+    static_schedule = load_json(DIVIDENDS_FILE).get("schedule", [])
+    # 予想は少なくとも2年先まで作っておき、近い期間の問い合わせではカレンダーを使い回す
+    calendar = get_calendar(
+        uid, holdings, static_schedule,
+        first_year=min(start.year, today.year - 2),
+        last_year=max(end.year, today.year + 2),
+    )
+    return calendar.query(start, end)
+
+
 # ---------- ニュース ----------
 
 @app.get("/api/news")
@@ -380,15 +548,34 @@ def get_news(ticker: str | None = Query(default=None, description="銘柄コー
     """
     保有銘柄に関連する最新ニュースをGoogle News RSSから取得。
     """
-    holdings = get_holdings()
+    holdings = get_holdings(user_id(user))
 
     if ticker:
         target = next((h for h in holdings if h["ticker"] == ticker), None)
         if target:
-            articles = fetch_news_for_ticker(target["ticker"], target["name"], limit=10)
+            articles = fetch_news_for_ticker(
+                target["ticker"], target["name"], limit=10, matcher=build_matcher(holdings)
+            )
         else:
             articles = []
     else:
         articles = fetch_all_news(holdings, limit_per_ticker=4)
 
     return {"articles": articles}
+
+
+# ---------- 管理者用: プロファイル ----------
+
+@app.get("/api/admin/profiles", dependencies=[Depends(require_profile_admin)])
+def get_profiles():
+    """保存済みのリクエストプロファイル一覧（新しい順、スタックは省略）"""
+    return {"profiles": list_profiles()}
+
+
+@app.get("/api/admin/profiles/{profile_id}", dependencies=[Depends(require_profile_admin)])
+def get_profile(profile_id: str):
+    """プロファイル1件の詳細（スパン内訳とサンプリングしたスタック）"""
+    record = load_profile(profile_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="プロファイルが見つかりません")
+    return record
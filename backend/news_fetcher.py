@@ -4,10 +4,20 @@ feedparser ライブラリでRSSを解析し、保有銘柄に関連するニュ
 """
 
 import feedparser
+import os
+import re
+import requests
 import time
+from functools import lru_cache
+from typing import Iterable
 from urllib.parse import quote
 from datetime import datetime, timezone
 
+from profiler import span, submit_traced
+
+# 接続先ベースURL（ベンチマーク時はローカルのスタブサーバーを指定する）
+GOOGLE_NEWS_BASE_URL = os.getenv("GOOGLE_NEWS_BASE_URL", "https://news.google.com").rstrip("/")
+
 
 def _parse_published(entry) -> str:
     """feedparserのエントリから日付文字列（ISO形式）を取得"""
@@ -30,7 +40,130 @@ def _get_source(entry) -> str:
     return "Google News"
 
 
-def fetch_news_for_ticker(ticker: str, name: str, limit: int = 5) -> list[dict]:
+# カテゴリ判定のキーワード（上にあるカテゴリほど優先）
+_CATEGORY_KEYWORDS: list[tuple[str, list[str]]] = [
+    ("配当", ["配当", "増配", "減配", "配当金"]),
+    ("業績", ["決算", "業績", "売上", "利益", "黒字", "赤字"]),
+    ("株価", ["株価", "上昇", "下落", "高値", "安値", "反発"]),
+]
+_CATEGORY_PRIORITY = {category: i for i, (category, _) in enumerate(_CATEGORY_KEYWORDS)}
+
+
+class NewsTextMatcher:
+    """
+    HTMLタグ除去・カテゴリ判定・保有銘柄（証券コード/銘柄名）の言及検出を、
+    事前コンパイルした1つの正規表現（選択パターン）による1回の走査で行う。
+    """
+
+    def __init__(self, holdings: Iterable[tuple[str, str]] = ()):
+        # 一致した文字列 → ("category", カテゴリ名) または ("ticker", 証券コード)
+        self._lookup: dict[str, tuple[str, str]] = {}
+        for category, words in _CATEGORY_KEYWORDS:
+            for word in words:
+                self._lookup.setdefault(word, ("category", category))
+        codes = set()
+        for ticker, name in holdings:
+            # 証券コードが空の銘柄は言及先にできないので照合対象にしない
+            if not ticker:
+                continue
+            codes.add(ticker)
+            if name:
+                self._lookup[name] = ("ticker", ticker)
+
+        # 「配当金」「配当」のような前方一致では長い方を優先する
+        parts = [f"(?P<word>{_trie_pattern(self._lookup)})"]
+        if codes:
+            # 証券コードは前後が英数字でない場合のみ（「27203円」などを誤検出しない）
+            parts.append(rf"(?<![0-9A-Za-z])(?P<code>{_trie_pattern(codes)})(?![0-9A-Za-z])")
+        first_chars = {w[0] for w in self._lookup} | {c[0] for c in codes}
+        # タイトルはプレーンテキストで「増配 <8306>」のような表記もあるため、タグとしては扱わない
+        self._title_pattern = _compile_alternation(parts, first_chars)
+        # 要約は HTML なので、タグの除去も同じ走査で行う
+        self._pattern = _compile_alternation([r"(?P<tag><[^>]+>)", *parts], first_chars | {"<"})
+
+    def _ticker_of(self, match: re.Match) -> str | None:
+        if match.lastgroup == "code":
+            return match.group()
+        if match.lastgroup == "word":
+            kind, value = self._lookup[match.group()]
+            if kind == "ticker":
+                return value
+        return None
+
+    def process(self, title: str, summary: str) -> tuple[str, str, list[str]]:
+        """
+        Returns:
+            (HTMLタグを除いた要約, タイトルから判定したカテゴリ, 言及された証券コードのリスト)
+        """
+        mentioned: set[str] = set()
+        best = None
+        for m in self._title_pattern.finditer(title):
+            if m.lastgroup == "word":
+                kind, value = self._lookup[m.group()]
+                if kind == "category":
+                    if best is None or _CATEGORY_PRIORITY[value] < _CATEGORY_PRIORITY[best]:
+                        best = value
+                    continue
+            ticker = self._ticker_of(m)
+            if ticker:
+                mentioned.add(ticker)
+
+        def _visit(m: re.Match) -> str:
+            if m.lastgroup == "tag":
+                return ""
+            ticker = self._ticker_of(m)
+            if ticker:
+                mentioned.add(ticker)
+            return m.group()
+
+        text = self._pattern.sub(_visit, summary) if summary else ""
+        return text, best or "ニュース", sorted(mentioned)
+
+
+def _compile_alternation(parts: list[str], first_chars: set[str]) -> re.Pattern:
+    """先頭文字の先読みで、どの語も始まり得ない位置を選択パターンに入る前に読み飛ばす"""
+    prefilter = "".join(sorted(re.escape(ch) for ch in first_chars))
+    return re.compile(f"(?=[{prefilter}])(?:{'|'.join(parts)})")
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    語の集合を文字単位のトライに畳んだ正規表現にする。
+    単純な選択パターン（a|b|c...）は語ごとに照合を試すため、語数が多いと遅くなる。
+    トライにすると各位置で先頭文字の一致する枝しか辿らない。長い語が優先される。
+    """
+    root: dict = {}
+    for word in words:
+        node = root
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def _build(node: dict) -> str:
+        branches = [re.escape(ch) + _build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        body = "(?:" + "|".join(branches) + ")"
+        return body + "?" if "" in node else body
+
+    return _build(root)
+
+
+@lru_cache(maxsize=32)
+def _cached_matcher(pairs: tuple[tuple[str, str], ...]) -> NewsTextMatcher:
+    return NewsTextMatcher(pairs)
+
+
+def build_matcher(holdings: list[dict]) -> NewsTextMatcher:
+    """保有銘柄リストから照合器を作る（同じ銘柄構成ならコンパイル済みのものを再利用）"""
+    return _cached_matcher(tuple(sorted((h["ticker"], h.get("name", "")) for h in holdings)))
+
+
+def fetch_news_for_ticker(
+    ticker: str, name: str, limit: int = 5, matcher: NewsTextMatcher | None = None
+) -> list[dict]:
     """
     指定銘柄のニュースをGoogle News RSSから取得する。
 
@@ -38,34 +171,41 @@ def fetch_news_for_ticker(ticker: str, name: str, limit: int = 5) -> list[dict]:
         ticker: 証券コード（例: "7203"）
         name: 銘柄名（例: "トヨタ自動車"）
         limit: 最大取得件数
+        matcher: 言及検出に使う照合器（省略時はこの銘柄のみを対象にする）
 
     Returns:
         ニュース記事のリスト
     """
     # 会社名で検索（株・配当キーワードを追加して金融ニュースに絞る）
     query = quote(f"{name}")
-    url = f"https://news.google.com/rss/search?q={query}&hl=ja&gl=JP&ceid=JP:ja"
+    url = f"{GOOGLE_NEWS_BASE_URL}/rss/search?q={query}&hl=ja&gl=JP&ceid=JP:ja"
 
     try:
-        feed = feedparser.parse(url)
+        # 通信と解析を分けて計測できるよう、取得は requests で行い feedparser には本文だけ渡す
+        with span("news_fetch"):
+            resp = requests.get(url, timeout=10)
+            resp.raise_for_status()
+        with span("news_parse"):
+            feed = feedparser.parse(resp.content)
+        if matcher is None:
+            matcher = build_matcher([{"ticker": ticker, "name": name}])
         articles = []
         for i, entry in enumerate(feed.entries[:limit]):
             title = getattr(entry, "title", "タイトルなし")
-            summary = getattr(entry, "summary", "")
-            # HTMLタグを除去した簡易テキスト
-            import re
-            summary = re.sub(r"<[^>]+>", "", summary)[:200]
+            # HTMLタグ除去・カテゴリ判定・保有銘柄の言及検出をまとめて行う
+            summary, category, mentioned = matcher.process(title, getattr(entry, "summary", ""))
 
             articles.append({
                 "id": f"{ticker}-{i}-{int(time.time())}",
                 "title": title,
-                "summary": summary,
+                "summary": summary[:200],
                 "source": _get_source(entry),
                 "published_at": _parse_published(entry),
                 "url": entry.link,
                 "related_ticker": ticker,
                 "related_name": name,
-                "category": _guess_category(title),
+                "category": category,
+                "mentioned_tickers": mentioned,
             })
         return articles
     except Exception as e:
@@ -73,17 +213,6 @@ def fetch_news_for_ticker(ticker: str, name: str, limit: int = 5) -> list[dict]:
         return []
 
 
-def _guess_category(title: str) -> str:
-    """タイトルからカテゴリを推測"""
-    if any(w in title for w in ["配当", "増配", "減配", "配当金"]):
-        return "配当"
-    if any(w in title for w in ["決算", "業績", "売上", "利益", "黒字", "赤字"]):
-        return "業績"
-    if any(w in title for w in ["株価", "上昇", "下落", "高値", "安値", "反発"]):
-        return "株価"
-    return "ニュース"
-
-
 def fetch_all_news(holdings: list[dict], limit_per_ticker: int = 5) -> list[dict]:
     """
     全保有銘柄のニュースを並列取得してマージ・重複除去する。
@@ -97,14 +226,18 @@ def fetch_all_news(holdings: list[dict], limit_per_ticker: int = 5) -> list[dict
     """
     from concurrent.futures import ThreadPoolExecutor
 
+    # 全銘柄分の照合器を1度だけ作り、他の保有銘柄への言及も検出できるようにする
+    matcher = build_matcher(holdings)
+
     def _fetch(h):
-        return fetch_news_for_ticker(h["ticker"], h["name"], limit=limit_per_ticker)
+        return fetch_news_for_ticker(h["ticker"], h["name"], limit=limit_per_ticker, matcher=matcher)
 
     all_articles = []
     seen_urls = set()
 
     with ThreadPoolExecutor(max_workers=min(len(holdings), 8)) as executor:
-        results = executor.map(_fetch, holdings)
+        futures = [submit_traced(executor, _fetch, h) for h in holdings]
+        results = [f.result() for f in futures]
 
     for articles in results:
         for article in articles:
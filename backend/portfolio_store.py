@@ -0,0 +1,341 @@
+"""
+ユーザーごとのポートフォリオ（保有銘柄）の保存と、よく使われるポートフォリオのメモリキャッシュ。
+
+- 認証済みユーザーは data/portfolios/{uid}.json、未認証（Firebase未設定の開発環境）は
+  従来どおり data/stocks.json を使う
+- 必要になった時点でファイルから読み込む。ファイルがないユーザー（再デプロイでファイルが消えた場合も含む）は
+  下記の移行状態に応じて旧共有ポートフォリオ（data/stocks.json）か Firestore の users/{uid}/holdings を初期値にする
+- 最近使われたポートフォリオを LRU で最大 PORTFOLIO_CACHE_SIZE 件メモリに保持し、
+  保存はファイルへ即時反映（write-through）する
+- メモリ上のポートフォリオが保有する銘柄の和集合を参照カウントで差分更新し、
+  PriceCacheWarmer がその和集合の株価をキャッシュ切れの前に1銘柄1回ずつ取得し直す。
+  複数ユーザーが同じ銘柄を持っていても取得は1回で、各ユーザーのリクエストはキャッシュから返る
+
+旧データの移行:
+    以前は全ユーザーが data/stocks.json を共有しており、Firestore には追加しか反映されていなかった
+    （削除・更新が反映されていない）。そのため移行が済むまでは、ファイルのないユーザーには
+    Firestore ではなく data/stocks.json の内容を見せる（以前と同じ表示）。
+    `python -m portfolio_store migrate [uid ...]` で、各ユーザーの Firestore を data/stocks.json
+    （そのユーザーのファイルがあればその内容）に合わせ、users/{uid} に移行済みの印（legacy_migrated_at）を
+    残す。uid 省略時は Firestore 上の全ユーザーを移行し、meta/portfolio_migration に全体の印も残す。
+    印は Firestore に置く（data/portfolios はデプロイ先によっては再デプロイで消えるため）。
+    移行済みのユーザーは再実行しても触らず、Firestore（write-behind で同期済み）の内容から始まる。
+    Firestore に接続できない場合は移行せず、印も残さない。
+
+環境変数:
+    PORTFOLIO_STOCKS_FILE    共有ポートフォリオのファイル（既定 data/stocks.json）
+    PORTFOLIOS_DIR           ユーザーごとのファイルの保存先（既定 data/portfolios）
+    PORTFOLIO_CACHE_SIZE     メモリに保持するポートフォリオ数（既定 256）
+    PORTFOLIO_WARM_INTERVAL  和集合の株価を取得し直す間隔（秒、既定 60。0 で無効）
+    PORTFOLIO_WARM_IDLE      この秒数ポートフォリオへのアクセスがなければ取得を休む（既定 600）
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Iterable
+
+from price_fetcher import CACHE_DURATION_SECONDS, fetch_prices
+from profiler import span
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+STOCKS_FILE = os.getenv("PORTFOLIO_STOCKS_FILE", os.path.join(DATA_DIR, "stocks.json"))
+PORTFOLIOS_DIR = os.getenv("PORTFOLIOS_DIR", os.path.join(DATA_DIR, "portfolios"))
+CACHE_SIZE = int(os.getenv("PORTFOLIO_CACHE_SIZE", "256"))
+WARM_INTERVAL_SECONDS = float(os.getenv("PORTFOLIO_WARM_INTERVAL", "60"))
+WARM_IDLE_SECONDS = float(os.getenv("PORTFOLIO_WARM_IDLE", "600"))
+
+FIRESTORE_RETRIES = 3
+FIRESTORE_BATCH_SIZE = 400  # 1バッチの書き込みは最大500件
+MIGRATION_DOC = ("meta", "portfolio_migration")  # 全ユーザーの移行が済んだ印
+MIGRATED_FIELD = "legacy_migrated_at"  # users/{uid} に残すユーザーごとの印
+
+_SAFE_UID = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+class PortfolioLoadError(Exception):
+    """ポートフォリオを読み込めなかった（空として扱うと保存時に既存データを消してしまう）"""
+
+
+def _default_client():
+    from firebase_config import get_firestore_client
+    return get_firestore_client()
+
+
+def _with_retries(what: str, fn: Callable):
+    """
+    Firestore の読み込みを数回再試行する。それでも失敗すれば PortfolioLoadError を送出する
+    （空として扱うと保存時に既存データを消してしまう）。
+    """
+    for attempt in range(FIRESTORE_RETRIES):
+        try:
+            return fn()
+        except Exception as e:
+            print(f"Firestore読み込みエラー ({attempt + 1}/{FIRESTORE_RETRIES}): {e}")
+            if attempt + 1 < FIRESTORE_RETRIES:
+                time.sleep(0.2 * 2 ** attempt)
+    raise PortfolioLoadError(f"Firestore から{what}を読み込めませんでした")
+
+
+def _is_migrated(user_snapshot) -> bool:
+    return bool(user_snapshot.exists and (user_snapshot.to_dict() or {}).get(MIGRATED_FIELD))
+
+
+class PortfolioStore:
+    """uid ごとの保有銘柄を LRU キャッシュ付きで読み書きする"""
+
+    def __init__(self, default_file: str = STOCKS_FILE, portfolios_dir: str = PORTFOLIOS_DIR,
+                 capacity: int = CACHE_SIZE, client_factory: Callable = _default_client):
+        self._default_file = default_file
+        self._portfolios_dir = portfolios_dir
+        self._capacity = max(1, capacity)
+        self._client_factory = client_factory
+        self._all_migrated = False  # 全体の移行の印を一度見たら以降は読みに行かない（移行は戻らない）
+        self._cache: OrderedDict[str | None, list[dict]] = OrderedDict()
+        self._ticker_refs: Counter[str] = Counter()  # 銘柄 → その銘柄を持つキャッシュ中のポートフォリオ数
+        self._last_access = 0.0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _path(self, uid: str | None) -> str:
+        if uid is None:
+            return self._default_file
+        # Firebase の uid は英数字だが、念のためファイル名に使えない文字はハッシュ化する
+        name = uid if _SAFE_UID.match(uid) else hashlib.sha256(uid.encode("utf-8")).hexdigest()
+        return os.path.join(self._portfolios_dir, f"{name}.json")
+
+    def _load_file(self, path: str) -> list[dict]:
+        with span("storage_load"), open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("holdings", [])
+
+    def _load_legacy(self) -> list[dict]:
+        return self._load_file(self._default_file) if os.path.exists(self._default_file) else []
+
+    def legacy_migrated(self, db, uid: str) -> bool:
+        """uid の Firestore が移行済みか（全体の印かユーザーごとの印があれば移行済み）"""
+        if self._all_migrated:
+            return True
+        ref = db.collection(MIGRATION_DOC[0]).document(MIGRATION_DOC[1])
+        if _with_retries("移行状態", lambda: ref.get()).exists:
+            self._all_migrated = True
+            return True
+        user_ref = db.collection("users").document(uid)
+        return _is_migrated(_with_retries("移行状態", lambda: user_ref.get()))
+
+    def _read(self, uid: str | None) -> list[dict]:
+        path = self._path(uid)
+        if os.path.exists(path):
+            return self._load_file(path)
+        if uid is None:
+            return []
+        db = self._client_factory()
+        if not db or not self.legacy_migrated(db, uid):
+            # 移行前は、以前と同じく共有ポートフォリオを見せる（Firestore 側は古い可能性がある）
+            return self._load_legacy()
+        holdings_ref = db.collection("users").document(uid).collection("holdings")
+        return _with_retries(f"ポートフォリオ (uid={uid})", lambda: [doc.to_dict() for doc in holdings_ref.stream()])
+
+    def _write(self, uid: str | None, holdings: list[dict]) -> None:
+        path = self._path(uid)
+        # 一時ファイルに書いてから置き換え、書き込み途中でファイルが壊れないようにする
+        tmp_path = f"{path}.tmp"
+        with span("storage_save"), self._write_lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = {"holdings": holdings}
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    data = {**json.load(f), "holdings": holdings}
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+
+    def _put(self, uid: str | None, holdings: list[dict]) -> None:
+        """キャッシュへ登録し、銘柄の参照カウントを差分更新する（ロック保持中に呼ぶ）"""
+        old = self._cache.pop(uid, None)
+        if old is not None:
+            self._release({h["ticker"] for h in old})
+        self._cache[uid] = holdings
+        self._ticker_refs.update({h["ticker"] for h in holdings})
+
+        while len(self._cache) > self._capacity:
+            _, evicted = self._cache.popitem(last=False)
+            self._release({h["ticker"] for h in evicted})
+
+    def _release(self, tickers: set[str]) -> None:
+        """参照カウントを減らし、参照がなくなった銘柄だけを和集合から外す（ロック保持中に呼ぶ）"""
+        for ticker in tickers:
+            self._ticker_refs[ticker] -= 1
+            if self._ticker_refs[ticker] <= 0:
+                del self._ticker_refs[ticker]
+
+    def get(self, uid: str | None) -> list[dict]:
+        """
+        保有銘柄を返す。呼び出し側が変更してもキャッシュに影響しないよう各要素はコピーする。
+        読み込みに失敗した場合は PortfolioLoadError（キャッシュにも載せない）。
+        """
+        with self._lock:
+            self._last_access = time.monotonic()
+            cached = self._cache.get(uid)
+            if cached is not None:
+                self._cache.move_to_end(uid)
+                return [dict(h) for h in cached]
+
+        holdings = self._read(uid)
+        with self._lock:
+            # 読み込み中に別スレッドが保存していればそちらを優先する
+            if uid not in self._cache:
+                self._put(uid, holdings)
+            else:
+                self._cache.move_to_end(uid)
+            return [dict(h) for h in self._cache[uid]]
+
+    def save(self, uid: str | None, holdings: list[dict]) -> None:
+        snapshot = [dict(h) for h in holdings]
+        self._write(uid, snapshot)
+        with self._lock:
+            self._last_access = time.monotonic()
+            self._put(uid, snapshot)
+
+    def migrate_legacy(self, uids: Iterable[str] | None = None) -> dict[str, list[dict]]:
+        """
+        各ユーザーの Firestore の保有銘柄を旧共有ポートフォリオ（そのユーザーのファイルがあればその内容）に
+        合わせ、ユーザーごとに移行済みの印を残す。移行したユーザーの uid → 保有銘柄 を返す。
+        移行済みの印があるユーザーは対象外（Firestore には一切書き込まない）。
+        uids を省略すると Firestore 上の全ユーザーを移行し、全体の印も残す。
+        Firestore に接続できなければ RuntimeError（何も書き込まない）。
+        """
+        db = self._client_factory()
+        if not db:
+            raise RuntimeError("Firestore に接続できません（Firebase の環境変数を確認してください）")
+        migrate_all = uids is None
+        if migrate_all:
+            uids = [doc.id for doc in db.collection("users").list_documents()]
+
+        legacy = self._load_legacy()
+        migrated = {}
+        for uid in uids:
+            user_ref = db.collection("users").document(uid)
+            if _is_migrated(user_ref.get()):
+                continue
+            path = self._path(uid)
+            holdings = self._load_file(path) if os.path.exists(path) else legacy
+            holdings_ref = user_ref.collection("holdings")
+            # 追加しか反映されていなかった Firestore から、削除済みの銘柄を消す
+            stale = {doc.id for doc in holdings_ref.list_documents()} - {h["ticker"] for h in holdings}
+            ops = [(holdings_ref.document(h["ticker"]), h) for h in holdings]
+            ops += [(holdings_ref.document(ticker), None) for ticker in sorted(stale)]
+            # 印は最後のバッチで書き、途中で失敗したユーザーは次回もう一度移行する
+            ops.append((user_ref, {MIGRATED_FIELD: time.strftime("%Y-%m-%dT%H:%M:%S")}))
+            for i in range(0, len(ops), FIRESTORE_BATCH_SIZE):
+                batch = db.batch()
+                for ref, data in ops[i:i + FIRESTORE_BATCH_SIZE]:
+                    if data is None:
+                        batch.delete(ref)
+                    elif ref is user_ref:
+                        batch.set(ref, data, merge=True)
+                    else:
+                        batch.set(ref, data)
+                batch.commit()
+            self.save(uid, holdings)
+            migrated[uid] = holdings
+
+        if migrate_all:
+            db.collection(MIGRATION_DOC[0]).document(MIGRATION_DOC[1]).set(
+                {"migrated_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "users": len(migrated)})
+            self._all_migrated = True
+        return migrated
+
+    def active_tickers(self, within: float | None = None) -> set[str]:
+        """
+        メモリ上の全ポートフォリオが保有する銘柄の和集合。
+        within を指定した場合、その秒数以内にアクセスがなければ空集合を返す。
+        """
+        with self._lock:
+            if within is not None and time.monotonic() - self._last_access > within:
+                return set()
+            return set(self._ticker_refs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "cached_portfolios": len(self._cache),
+                "active_tickers": len(self._ticker_refs),
+                # 和集合にまとめる前の延べ銘柄数（共有銘柄が多いほど active_tickers との差が大きい）
+                "ticker_references": sum(self._ticker_refs.values()),
+            }
+
+
+class PriceCacheWarmer:
+    """
+    メモリ上のポートフォリオの銘柄の和集合について、共有の価格キャッシュが切れる前に
+    一定間隔でまとめて取得し直す。銘柄はユーザー数によらず1回ずつしか取得しない。
+    """
+
+    def __init__(self, tickers: Callable[[], set[str]], fetcher: Callable = fetch_prices,
+                 interval: float = WARM_INTERVAL_SECONDS):
+        self._tickers = tickers
+        self._fetcher = fetcher
+        self._interval = interval
+        # 次の周期までにキャッシュが切れるものだけを取得し直す
+        self._max_age = max(0.0, CACHE_DURATION_SECONDS - interval)
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def warm(self) -> int:
+        """和集合のうちキャッシュ切れが近い銘柄を取得する。対象の銘柄数を返す。"""
+        tickers = sorted(self._tickers())
+        if tickers:
+            try:
+                self._fetcher(tickers, max_age=self._max_age)
+            except Exception as e:
+                print(f"株価の先読みエラー: {e}")
+        return len(tickers)
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self._interval):
+            self.warm()
+
+    def start(self) -> None:
+        if self._interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="price-cache-warmer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+
+# アプリ全体で共有するストアと先読み
+portfolio_store = PortfolioStore()
+price_warmer = PriceCacheWarmer(lambda: portfolio_store.active_tickers(within=WARM_IDLE_SECONDS))
+
+
+def _migrate(uids: list[str]) -> None:
+    """旧共有ポートフォリオを各ユーザーの Firestore へ移す"""
+    try:
+        migrated = portfolio_store.migrate_legacy(uids or None)
+    except RuntimeError as e:
+        print(f"移行できません: {e}")
+        sys.exit(1)
+    for uid, holdings in migrated.items():
+        print(f"{uid}: {len(holdings)}銘柄を移行しました")
+    print(f"移行完了: {len(migrated)}ユーザー（移行済みのユーザーは対象外）")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["migrate"]:
+        print("使い方: python -m portfolio_store migrate [uid ...]")
+        sys.exit(1)
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    _migrate(sys.argv[2:])
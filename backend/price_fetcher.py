@@ -5,9 +5,15 @@ SSL証明書のパス問題を回避するため、yfinanceではなくrequests
 
 import json
 import os
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
 import requests
 
+from dividend_calendar import dividend_index
+from profiler import span, submit_traced
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
 }
@@ -53,8 +59,11 @@ _SECTOR_MAP: dict[str, str] = {
     "化学": "その他",
 }
 
+# 接続先ベースURL（ベンチマーク時はローカルのスタブサーバーを指定する）
+YAHOO_BASE_URL = os.getenv("YAHOO_BASE_URL", "https://query1.finance.yahoo.com").rstrip("/")
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
-CACHE_FILE = os.path.join(DATA_DIR, "price_cache.json")
+CACHE_FILE = os.getenv("PRICE_CACHE_FILE", os.path.join(DATA_DIR, "price_cache.json"))
 CACHE_DURATION_SECONDS = 300  # 5分キャッシュ
 
 
@@ -65,10 +74,20 @@ def to_yahoo_symbol(ticker: str) -> str:
     return f"{ticker}.T"
 
 
+# 全ユーザー共通の価格キャッシュ（銘柄単位）。ファイルは最初に1度だけ読み、
+# 以降はメモリ上で参照して一括取得の最後にまとめて保存する
+_price_cache: dict | None = None
+_cache_dirty = False
+_cache_lock = threading.Lock()
+_save_lock = threading.Lock()
+# 取得中の銘柄 → 結果待ちの Future（複数ユーザーが同じ銘柄を同時に取りに行っても通信は1回）
+_inflight: dict[str, Future] = {}
+
+
 def _load_cache() -> dict:
     if os.path.exists(CACHE_FILE):
         try:
-            with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            with span("price_cache_load"), open(CACHE_FILE, "r", encoding="utf-8") as f:
                 return json.load(f)
         except Exception:
             pass
@@ -76,47 +95,99 @@ def _load_cache() -> dict:
 
 
 def _save_cache(cache: dict) -> None:
+    tmp_path = f"{CACHE_FILE}.tmp"
     try:
-        with open(CACHE_FILE, "w", encoding="utf-8") as f:
-            json.dump(cache, f, ensure_ascii=False)
+        with span("price_cache_save"), _save_lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(tmp_path, CACHE_FILE)
     except Exception as e:
         print(f"キャッシュ保存エラー: {e}")
 
 
-def fetch_price(ticker: str) -> float | None:
-    """1銘柄の現在値を取得（5分キャッシュあり）"""
-    cache = _load_cache()
-    now = time.time()
+def _memory_cache() -> dict:
+    """メモリ上の価格キャッシュ（_cache_lock を保持して呼ぶこと）"""
+    global _price_cache
+    if _price_cache is None:
+        _price_cache = _load_cache()
+    return _price_cache
+
+
+def _flush_cache() -> None:
+    """前回保存以降に更新があればキャッシュファイルへ書き出す"""
+    global _cache_dirty
+    with _cache_lock:
+        if not _cache_dirty:
+            return
+        snapshot = dict(_memory_cache())
+        _cache_dirty = False
+    _save_cache(snapshot)
+
+
+def clear_cache() -> None:
+    """価格キャッシュをメモリ・ファイルとも破棄する"""
+    global _price_cache, _cache_dirty
+    with _cache_lock:
+        _price_cache = {}
+        _cache_dirty = False
+    if os.path.exists(CACHE_FILE):
+        os.remove(CACHE_FILE)
 
-    if ticker in cache:
-        entry = cache[ticker]
-        if now - entry["timestamp"] < CACHE_DURATION_SECONDS:
-            return entry["price"]
 
+def _download_price(ticker: str) -> float | None:
     symbol = to_yahoo_symbol(ticker)
-    url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}?interval=1d&range=1d"
+    url = f"{YAHOO_BASE_URL}/v8/finance/chart/{symbol}?interval=1d&range=1d"
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        price = data["chart"]["result"][0]["meta"]["regularMarketPrice"]
-        cache[ticker] = {"price": float(price), "timestamp": now}
-        _save_cache(cache)
-        return float(price)
+        with span("price_fetch"):
+            resp = requests.get(url, headers=HEADERS, timeout=10)
+            resp.raise_for_status()
+            data = resp.json()
+        return float(data["chart"]["result"][0]["meta"]["regularMarketPrice"])
     except Exception as e:
         print(f"価格取得エラー ({ticker}): {e}")
         return None
 
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+def fetch_price(ticker: str, max_age: float = CACHE_DURATION_SECONDS) -> float | None:
+    """
+    1銘柄の現在値を取得（max_age 秒以内のキャッシュがあればそれを返す）。
+    ファイルへの保存は fetch_prices の最後にまとめて行う。
+    """
+    global _cache_dirty
+    now = time.time()
+    with _cache_lock:
+        entry = _memory_cache().get(ticker)
+        if entry and now - entry["timestamp"] < max_age:
+            return entry["price"]
+        future = _inflight.get(ticker)
+        owner = future is None
+        if owner:
+            future = _inflight[ticker] = Future()
+
+    if not owner:
+        # 同じ銘柄を別のリクエストが取得中なので、その結果を待つ
+        return future.result()
 
-def fetch_prices(tickers: list[str]) -> dict[str, float | None]:
+    price = None
+    try:
+        price = _download_price(ticker)
+    finally:
+        with _cache_lock:
+            if price is not None:
+                _memory_cache()[ticker] = {"price": price, "timestamp": now}
+                _cache_dirty = True
+            _inflight.pop(ticker, None)
+        future.set_result(price)
+    return price
+
+
+def fetch_prices(tickers: list[str], max_age: float = CACHE_DURATION_SECONDS) -> dict[str, float | None]:
     """複数銘柄の現在値を並列で一括取得"""
     result = {}
     # Yahoo Finance APIへの負荷を考慮し、ワーカー数は適度に制限（例: 8）
     with ThreadPoolExecutor(max_workers=8) as executor:
         future_to_ticker = {
-            executor.submit(fetch_price, ticker): ticker for ticker in tickers
+            submit_traced(executor, fetch_price, ticker, max_age): ticker for ticker in tickers
         }
         for future in as_completed(future_to_ticker):
             ticker = future_to_ticker[future]
@@ -125,6 +196,7 @@ def fetch_prices(tickers: list[str]) -> dict[str, float | None]:
             except Exception as e:
                 print(f"並列取得エラー ({ticker}): {e}")
                 result[ticker] = None
+    _flush_cache()
     return result
 
 
@@ -175,11 +247,12 @@ def _fetch_sector_from_search(symbol: str) -> str:
     # シンボルからコード部分を抽出（例: "7203.T" -> "7203"）
     ticker_part = symbol.split(".")[0]
     
-    url = f"https://query1.finance.yahoo.com/v1/finance/search?q={symbol}&quotesCount=1"
+    url = f"{YAHOO_BASE_URL}/v1/finance/search?q={symbol}&quotesCount=1"
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=8)
-        resp.raise_for_status()
-        quotes = resp.json().get("quotes", [])
+        with span("sector_fetch"):
+            resp = requests.get(url, headers=HEADERS, timeout=8)
+            resp.raise_for_status()
+            quotes = resp.json().get("quotes", [])
         if quotes:
             quote = quotes[0]
             # ETF・投資信託は quoteType で判定
@@ -197,22 +270,28 @@ def _fetch_sector_from_search(symbol: str) -> str:
     return _guess_sector_from_ticker(ticker_part)
 
 
-def _fetch_annual_dividend(symbol: str) -> float:
-    """v8/chart の events=div から過去1年間の配当合計を取得"""
+def _fetch_annual_dividend(symbol: str, record_events: bool = True) -> float:
+    """
+    v8/chart の events=div から過去1年間の配当合計を取得。
+    取得した日付ごとの配当イベントは配当カレンダー用の索引にも保存する（record_events=False なら保存しない）。
+    """
     url = (
-        f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+        f"{YAHOO_BASE_URL}/v8/finance/chart/{symbol}"
         f"?interval=3mo&range=2y&events=div"
     )
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
+        with span("dividend_fetch"):
+            resp = requests.get(url, headers=HEADERS, timeout=10)
+            resp.raise_for_status()
+            data = resp.json()
         events = (
             data.get("chart", {})
             .get("result", [{}])[0]
             .get("events", {})
             .get("dividends", {})
         )
+        if events and record_events:
+            dividend_index.update(symbol.removesuffix(".T"), events)
         cutoff = time.time() - 365 * 24 * 3600
         total = sum(v["amount"] for v in events.values() if v["date"] >= cutoff)
         return float(total)
@@ -220,16 +299,20 @@ def _fetch_annual_dividend(symbol: str) -> float:
         return 0.0
 
 
-def fetch_stock_info(ticker: str) -> dict | None:
-    """銘柄の基本情報（名称・現在価格・年間配当・セクター）を取得"""
+def fetch_stock_info(ticker: str, record_events: bool = True) -> dict | None:
+    """
+    銘柄の基本情報（名称・現在価格・年間配当・セクター）を取得。
+    record_events=False なら配当イベントを索引に保存しない（検証のみの取り込みなど）。
+    """
     symbol = to_yahoo_symbol(ticker)
 
     # v8/chart で名称・現在値を取得（v7/quote は 2025年以降 401 のため非使用）
-    chart_url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}?interval=1d&range=1d"
+    chart_url = f"{YAHOO_BASE_URL}/v8/finance/chart/{symbol}?interval=1d&range=1d"
     try:
-        resp = requests.get(chart_url, headers=HEADERS, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
+        with span("price_fetch"):
+            resp = requests.get(chart_url, headers=HEADERS, timeout=10)
+            resp.raise_for_status()
+            data = resp.json()
         meta = data["chart"]["result"][0]["meta"]
     except Exception as e:
         print(f"銘柄情報取得エラー ({ticker}): {e}")
@@ -241,7 +324,7 @@ def fetch_stock_info(ticker: str) -> dict | None:
     exchange = meta.get("exchangeName", "")
 
     # 配当・セクターは別 API で補完
-    annual_dividend = _fetch_annual_dividend(symbol)
+    annual_dividend = _fetch_annual_dividend(symbol, record_events)
     sector = _fetch_sector_from_search(symbol)
 
     return {
@@ -258,13 +341,12 @@ def fetch_stock_info(ticker: str) -> dict | None:
 
 def get_cache_updated_at() -> str | None:
     """キャッシュの最終更新日時を返す（日本時間のISO形式）"""
-    if not os.path.exists(CACHE_FILE):
-        return None
     try:
-        cache = _load_cache()
-        if not cache:
-            return None
-        latest = max(v["timestamp"] for v in cache.values())
+        with _cache_lock:
+            cache = _memory_cache()
+            if not cache:
+                return None
+            latest = max(v["timestamp"] for v in cache.values())
         import datetime
         JST = datetime.timezone(datetime.timedelta(hours=9))
         return datetime.datetime.fromtimestamp(latest, tz=JST).isoformat()
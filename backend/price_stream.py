@@ -0,0 +1,182 @@
+"""
+株価のプッシュ配信（Server-Sent Events）。
+
+- ワーカー内で1つだけ動くポーラーが、購読中の全銘柄（和集合）を一定間隔で1回ずつ取得する
+- 前回から変化した銘柄だけを、その銘柄を購読しているクライアントに配る
+- 各クライアントは「未送信の最新価格」を銘柄ごとに1件だけ持つ。送信が遅いクライアントでも
+  古い価格は新しい価格で上書きされるだけなので、メモリは購読銘柄数までしか増えない
+- 待機中の接続はイベント待ちのコルーチン1つだけなので、数千接続でも負荷は小さい
+- ブラウザの EventSource は Authorization ヘッダーを付けられないため、接続には
+  issue_stream_token で発行した短命トークンをクエリパラメータで渡す
+
+環境変数:
+    PRICE_STREAM_INTERVAL      ポーリング間隔（秒、既定 30）
+    PRICE_STREAM_HEARTBEAT     無通信時のキープアライブ送信間隔（秒、既定 15）
+    PRICE_STREAM_TOKEN_TTL     接続用トークンの有効期間（秒、既定 60）
+    PRICE_STREAM_TOKEN_SECRET  トークンの署名鍵（未設定ならプロセスごとに生成。複数ワーカー時は必須）
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable
+
+from fastapi.concurrency import run_in_threadpool
+
+from price_fetcher import fetch_prices
+
+POLL_INTERVAL_SECONDS = float(os.getenv("PRICE_STREAM_INTERVAL", "30"))
+HEARTBEAT_SECONDS = float(os.getenv("PRICE_STREAM_HEARTBEAT", "15"))
+TOKEN_TTL_SECONDS = int(os.getenv("PRICE_STREAM_TOKEN_TTL", "60"))
+_TOKEN_SECRET = os.getenv("PRICE_STREAM_TOKEN_SECRET", "").encode("utf-8") or secrets.token_bytes(32)
+
+JST = timezone(timedelta(hours=9))
+
+
+# ---------- 接続用トークン ----------
+
+def _sign(payload: str) -> str:
+    return hmac.new(_TOKEN_SECRET, payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def issue_stream_token(uid: str) -> str:
+    """uid と有効期限に署名した短命トークンを発行する"""
+    payload = f"{uid}:{int(time.time()) + TOKEN_TTL_SECONDS}"
+    return base64.urlsafe_b64encode(f"{payload}:{_sign(payload)}".encode("utf-8")).decode("ascii")
+
+
+def verify_stream_token(token: str) -> str | None:
+    """トークンが正しく期限内であれば uid を返す"""
+    try:
+        payload, signature = base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8").rsplit(":", 1)
+        uid, expires = payload.rsplit(":", 1)
+        if not hmac.compare_digest(signature, _sign(payload)) or int(expires) < time.time():
+            return None
+    except Exception:
+        return None
+    return uid
+
+
+class _Subscriber:
+    """1接続分の購読状態。未送信の価格は銘柄ごとに最新の1件だけ保持する。"""
+
+    __slots__ = ("tickers", "pending", "event")
+
+    def __init__(self, tickers: frozenset[str]):
+        self.tickers = tickers
+        self.pending: dict[str, float] = {}
+        self.event = asyncio.Event()
+
+    def offer(self, prices: dict[str, float]) -> None:
+        self.pending.update(prices)
+        self.event.set()
+
+    def drain(self) -> dict[str, float]:
+        prices, self.pending = self.pending, {}
+        self.event.clear()
+        return prices
+
+
+class PriceBroadcaster:
+    """購読銘柄の和集合を1つのポーラーで取得し、差分を購読者へ配る"""
+
+    def __init__(self, fetcher: Callable = fetch_prices, interval: float = POLL_INTERVAL_SECONDS):
+        self._fetcher = fetcher
+        self._interval = interval
+        self._subscribers: dict[str, set[_Subscriber]] = {}  # 銘柄 → 購読者
+        self._latest: dict[str, float] = {}
+        self._updated_at: str | None = None
+        self._task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+
+    def subscribe(self, tickers: list[str]) -> _Subscriber:
+        sub = _Subscriber(frozenset(tickers))
+        # 取得済みの価格があれば最初にまとめて送る
+        snapshot = {t: self._latest[t] for t in sub.tickers if t in self._latest}
+        if snapshot:
+            sub.offer(snapshot)
+
+        new_tickers = False
+        for t in sub.tickers:
+            subs = self._subscribers.get(t)
+            if subs is None:
+                subs = self._subscribers[t] = set()
+                new_tickers = True
+            subs.add(sub)
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._poll())
+        elif new_tickers:
+            # 未取得の銘柄が増えたので次の周期を待たずに取得する
+            self._wakeup.set()
+        return sub
+
+    def unsubscribe(self, sub: _Subscriber) -> None:
+        for t in sub.tickers:
+            subs = self._subscribers.get(t)
+            if subs is None:
+                continue
+            subs.discard(sub)
+            if not subs:
+                del self._subscribers[t]
+                self._latest.pop(t, None)
+
+    async def _poll(self) -> None:
+        while self._subscribers:
+            tickers = list(self._subscribers)
+            try:
+                # キャッシュは間隔内のものだけ使う（REST API 側とキャッシュを共有）
+                prices = await run_in_threadpool(self._fetcher, tickers, max_age=self._interval)
+            except Exception as e:
+                print(f"価格配信の取得エラー: {e}")
+                prices = {}
+
+            changed = {
+                t: p for t, p in prices.items()
+                if p is not None and t in self._subscribers and self._latest.get(t) != p
+            }
+            if changed:
+                self._latest.update(changed)
+                self._updated_at = datetime.now(JST).isoformat()
+                per_subscriber: dict[_Subscriber, dict[str, float]] = {}
+                for t, p in changed.items():
+                    for sub in self._subscribers.get(t, ()):
+                        per_subscriber.setdefault(sub, {})[t] = p
+                for sub, diff in per_subscriber.items():
+                    sub.offer(diff)
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def stream(self, tickers: list[str]) -> AsyncIterator[str]:
+        """SSE 形式のイベント列。切断されると購読を解除する。"""
+        sub = self.subscribe(tickers)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    await asyncio.wait_for(sub.event.wait(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                prices = sub.drain()
+                if not prices:
+                    continue
+                payload = {"prices": prices, "updated_at": self._updated_at}
+                yield f"event: prices\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+
+# ワーカー内で共有する配信器
+broadcaster = PriceBroadcaster()
@@ -0,0 +1,318 @@
+"""
+リクエスト単位のオプトイン・プロファイラ。
+
+管理者用ヘッダー（X-Profile-Token）付きのリクエスト、または PROFILE_SAMPLE_RATE の確率で
+抽選されたリクエストについて、以下を記録する:
+- スパン内訳（storage_load / price_fetch / dividend_fetch / news_fetch / news_parse /
+  pool_wait / endpoint / serialization など）の合計時間と回数
+- サンプリングプロファイル（一定間隔で全スレッドのスタックを採取した collapsed 形式）
+
+結果は PROFILE_DIR に1件1ファイルで保存し、PROFILE_RING_SIZE 件を超えたら古いものから削除する。
+
+環境変数:
+    PROFILE_ADMIN_TOKEN        管理者トークン（未設定ならヘッダー指定・管理APIは無効）
+    PROFILE_SAMPLE_RATE        抽選で計測する割合（0.0〜1.0、既定 0）
+    PROFILE_SAMPLE_INTERVAL_MS スタック採取間隔（既定 5ms）
+    PROFILE_RING_SIZE          保存する最大件数（既定 50）
+    PROFILE_DIR                保存先（既定 data/profiles）
+
+注意: スタック採取はプロセス内の全スレッドが対象のため、同時に処理中の別リクエストの
+スタックも混ざる。スパン内訳は contextvars でリクエストごとに分離されている。
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from fastapi import Header, HTTPException
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers, MutableHeaders
+
+PROFILE_HEADER = "X-Profile-Token"
+
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR", os.path.join(os.path.dirname(__file__), "data", "profiles")
+)
+
+# 計測対象外のパス（管理API自身と、SSE などの長時間接続）
+_EXCLUDED_PREFIXES = ("/api/admin/", "/api/stream/")
+
+# 1プロファイルあたりに保存するスタックの最大種類数（ファイルサイズを抑えるため）
+MAX_STACKS = 200
+
+_active: contextvars.ContextVar["_Profile | None"] = contextvars.ContextVar("active_profile", default=None)
+
+
+class _Profile:
+    """1リクエスト分の計測結果"""
+
+    def __init__(self, method: str, path: str, trigger: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.spans: dict[str, dict] = {}
+        self.endpoint_done: float | None = None
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float) -> None:
+        with self._lock:
+            entry = self.spans.setdefault(name, {"total_ms": 0.0, "count": 0})
+            entry["total_ms"] += seconds * 1000
+            entry["count"] += 1
+
+
+class _StackSampler(threading.Thread):
+    """一定間隔で全スレッドのスタックを採取するサンプリングプロファイラ"""
+
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def stop(self, wait: bool = True) -> None:
+        self._stop_event.set()
+        if wait:
+            self.join()
+
+
+# ---------- スパン計測 ----------
+
+@contextmanager
+def span(name: str):
+    """計測中のリクエストであれば、ブロックの所要時間をスパンとして記録する"""
+    profile = _active.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(name, time.perf_counter() - start)
+
+
+def submit_traced(executor, fn, *args, **kwargs):
+    """
+    executor.submit の代わりに使う。ワーカースレッドへ計測コンテキストを引き継ぎ、
+    キュー待ち時間を pool_wait スパンとして記録する。
+    """
+    ctx = contextvars.copy_context()
+    submitted = time.perf_counter()
+
+    def _run():
+        profile = _active.get()
+        if profile is not None:
+            profile.add_span("pool_wait", time.perf_counter() - submitted)
+        return fn(*args, **kwargs)
+
+    return executor.submit(ctx.run, _run)
+
+
+class ProfiledRoute(APIRoute):
+    """エンドポイント関数の実行時間を endpoint スパンとして記録するルート"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _wrap_endpoint(endpoint), **kwargs)
+
+
+def _wrap_endpoint(endpoint):
+    def _finish(profile: "_Profile | None", start: float) -> None:
+        if profile is not None:
+            now = time.perf_counter()
+            profile.add_span("endpoint", now - start)
+            profile.endpoint_done = now
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            profile, start = _active.get(), time.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                _finish(profile, start)
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile, start = _active.get(), time.perf_counter()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            _finish(profile, start)
+    return wrapper
+
+
+# ---------- 保存（ディスク上のリングバッファ） ----------
+
+# サンプラーの終了待ちとファイル書き込みはイベントループを止めないよう、この1スレッドで順に行う
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile-writer")
+
+def _save_profile(record: dict) -> None:
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        filename = f"{time.time_ns()}-{record['id']}.json"
+        with open(os.path.join(PROFILE_DIR, filename), "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+
+        files = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith(".json"))
+        for old in files[:-PROFILE_RING_SIZE] if PROFILE_RING_SIZE > 0 else files:
+            os.remove(os.path.join(PROFILE_DIR, old))
+    except Exception as e:
+        print(f"プロファイル保存エラー: {e}")
+
+
+def _profile_files() -> list[str]:
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True)
+
+
+def list_profiles() -> list[dict]:
+    """保存済みプロファイルの概要を新しい順に返す（スタックは含まない）"""
+    summaries = []
+    for name in _profile_files():
+        try:
+            with open(os.path.join(PROFILE_DIR, name), "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except Exception:
+            continue
+        record.pop("stacks", None)
+        summaries.append(record)
+    return summaries
+
+
+def load_profile(profile_id: str) -> dict | None:
+    for name in _profile_files():
+        if name.endswith(f"-{profile_id}.json"):
+            with open(os.path.join(PROFILE_DIR, name), "r", encoding="utf-8") as f:
+                return json.load(f)
+    return None
+
+
+# ---------- ミドルウェア ----------
+
+def _is_admin_token(token: str | None) -> bool:
+    return bool(PROFILE_ADMIN_TOKEN) and bool(token) and secrets.compare_digest(
+        token.encode("utf-8"), PROFILE_ADMIN_TOKEN.encode("utf-8")
+    )
+
+
+def require_profile_admin(x_profile_token: str | None = Header(default=None)) -> None:
+    """管理API用の依存関数。トークン未設定時は機能自体を無効として404を返す。"""
+    if not PROFILE_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="プロファイル機能は無効です")
+    if not _is_admin_token(x_profile_token):
+        raise HTTPException(status_code=403, detail="管理者トークンが必要です")
+
+
+class ProfilingMiddleware:
+    """
+    対象リクエストのみスパン内訳とスタックを記録する。それ以外は素通し。
+    SSE などの長時間接続を包まないよう、BaseHTTPMiddleware ではなく素の ASGI ミドルウェアとして実装。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        if not path.startswith("/api/") or path.startswith(_EXCLUDED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        if _is_admin_token(Headers(scope=scope).get(PROFILE_HEADER)):
+            trigger = "header"
+        elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            trigger = "sampled"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        profile = _Profile(scope["method"], path, trigger)
+        status_code = 500
+        response_started: float | None = None
+
+        async def send_with_profile_id(message):
+            nonlocal status_code, response_started
+            if message["type"] == "http.response.start":
+                response_started = time.perf_counter()
+                status_code = message["status"]
+                MutableHeaders(scope=message).append("X-Profile-Id", profile.id)
+            await send(message)
+
+        token = _active.set(profile)
+        sampler = _StackSampler(PROFILE_SAMPLE_INTERVAL_MS / 1000)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            end = time.perf_counter()
+            # ここはイベントループ上なので、スレッドの終了待ちはせず停止の合図だけ送る
+            sampler.stop(wait=False)
+            _active.reset(token)
+
+            # エンドポイント終了からレスポンス送信開始までをシリアライズ時間とみなす
+            if profile.endpoint_done is not None and response_started is not None:
+                profile.add_span("serialization", response_started - profile.endpoint_done)
+
+            record = {
+                "id": profile.id,
+                "method": profile.method,
+                "path": profile.path,
+                "query": scope.get("query_string", b"").decode("latin-1"),
+                "trigger": trigger,
+                "status_code": status_code,
+                "started_at": profile.started_at,
+                "duration_ms": round((end - start) * 1000, 2),
+                "spans": {
+                    k: {"total_ms": round(v["total_ms"], 2), "count": v["count"]}
+                    for k, v in sorted(profile.spans.items(), key=lambda kv: -kv[1]["total_ms"])
+                },
+            }
+            _writer.submit(_finish_profile, record, sampler)
+
+
+def _finish_profile(record: dict, sampler: _StackSampler) -> None:
+    """サンプラーの終了を待ってスタックを加え、保存する（書き込みスレッドで実行）"""
+    sampler.join()
+    record["samples"] = sampler.samples
+    record["stacks"] = dict(sampler.stacks.most_common(MAX_STACKS))
+    _save_profile(record)
@@ -0,0 +1,62 @@
+"""証券会社CSVの解析（文字コード判定・口座ごとのヘッダー行・同一銘柄の合算）"""
+
+import asyncio
+
+from csv_importer import parse_holdings_csv
+
+SBI_CSV = """ポートフォリオ一覧
+"株式（現物/特定預り）合計","評価額","1,000,000"
+"株式（現物/特定預り）"
+"銘柄（コード）","買付日","数量","取得単価","現在値","評価額"
+"7203 トヨタ自動車","----/--/--","100","2,000","2,500","250,000"
+"9432 NTT","----/--/--","1000","150","160","160,000"
+"株式（現物/NISA預り（成長投資枠））合計","評価額","500,000"
+"株式（現物/NISA預り（成長投資枠））"
+"銘柄（コード）","買付日","数量","取得単価","現在値","評価額"
+"7203 トヨタ自動車","----/--/--","200","2,600","2,500","500,000"
+"""
+
+
+def _parse(data: bytes, chunk_size: int = 0):
+    async def chunks():
+        if not chunk_size:
+            yield data
+            return
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    return asyncio.run(parse_holdings_csv(chunks()))
+
+
+def test_repeated_account_headers_and_duplicate_tickers_are_merged():
+    valid, errors = _parse(SBI_CSV.encode("utf-8"))
+    assert errors == []
+    by_ticker = {r["ticker"]: r for r in valid}
+    assert set(by_ticker) == {"7203", "9432"}
+
+    toyota = by_ticker["7203"]
+    assert toyota["name"] == "トヨタ自動車"
+    assert toyota["shares"] == 300
+    assert toyota["average_cost"] == 2400.0  # (100 * 2000 + 200 * 2600) / 300
+    assert toyota["row"] == 5
+    assert toyota["merged_rows"] == [5, 10]
+    assert by_ticker["9432"]["merged_rows"] == [6]
+
+
+def test_shift_jis_and_utf8_give_the_same_result():
+    utf8 = _parse(SBI_CSV.encode("utf-8"))
+    utf8_bom = _parse("\ufeff".encode("utf-8") + SBI_CSV.encode("utf-8"))
+    # 小さなチャンクに分けても、マルチバイト文字の途中で切れて化けないこと
+    cp932 = _parse(SBI_CSV.encode("cp932"), chunk_size=7)
+    assert utf8 == utf8_bom == cp932
+
+
+def test_invalid_rows_are_reported_and_headerless_file_is_rejected():
+    data = "コード,銘柄名,保有株数,取得単価\n7203,トヨタ,100,2000\nAAPL,Apple,5,100\n8306,三菱UFJ,1.5,900\n"
+    valid, errors = _parse(data.encode("utf-8"))
+    assert [r["ticker"] for r in valid] == ["7203"]
+    assert [(e["row"], e["ticker"]) for e in errors] == [(3, "AAPL"), (4, "8306")]
+
+    valid, errors = _parse("a,b,c\n1,2,3\n".encode("utf-8"))
+    assert valid == []
+    assert errors[0]["row"] is None
@@ -0,0 +1,112 @@
+"""DividendCalendar の期間集計と将来分の推定"""
+
+from datetime import date, datetime
+
+import pytest
+
+from dividend_calendar import JST, DividendCalendar, DividendEventIndex, get_calendar
+
+
+def _ts(iso: str) -> float:
+    return datetime.fromisoformat(f"{iso}T00:00:00").replace(tzinfo=JST).timestamp()
+
+
+@pytest.fixture
+def index(tmp_path):
+    idx = DividendEventIndex(str(tmp_path / "events.json"))
+    # 3月・9月の年2回（実績は 2025-09 と 2026-03 の2回）
+    idx.update("7203", {
+        "a": {"amount": 40.0, "date": _ts("2025-09-29")},
+        "b": {"amount": 60.0, "date": _ts("2026-03-30")},
+    })
+    return idx
+
+
+def _holding(ticker="7203", annual=100.0, shares=100):
+    return {"ticker": ticker, "name": f"銘柄{ticker}", "shares": shares, "annual_dividend_per_share": annual}
+
+
+def test_projections_repeat_last_year_across_years(index):
+    calendar = DividendCalendar([_holding()], index, [], 2025, 2028)
+    result = calendar.query(date(2025, 1, 1), date(2028, 12, 31))
+
+    dates = [(e["ex_date"], e["projected"]) for e in result["entries"]]
+    assert dates == [
+        ("2025-09-29", False), ("2026-03-30", False),
+        ("2026-09-29", True), ("2027-03-30", True),
+        ("2027-09-29", True), ("2028-03-30", True),
+        ("2028-09-29", True),
+    ]
+    # 1年分（9月 + 3月）の合計は年間配当 × 株数
+    assert sum(e["amount"] for e in result["entries"][2:4]) == 100 * 100
+
+
+def test_amounts_follow_holding_annual_dividend(index):
+    calendar = DividendCalendar([_holding(annual=10.0)], index, [], 2026, 2027)
+    year = calendar.query(date(2027, 1, 1), date(2027, 12, 31))
+    assert year["total"] == 10 * 100
+    # 実績の比率（40:60）で配分する
+    assert [e["amount"] for e in year["entries"]] == [600, 400]
+
+    assert DividendCalendar([_holding(annual=0)], index, [], 2026, 2027).query(
+        date(2026, 1, 1), date(2027, 12, 31))["entries"] == []
+
+
+def test_partial_edge_months_use_only_days_in_range(index):
+    calendar = DividendCalendar([_holding()], index, [], 2026, 2027)
+    result = calendar.query(date(2026, 3, 31), date(2026, 9, 29))
+
+    months = {m["month"]: m["total"] for m in result["months"]}
+    assert list(months) == [f"2026-{m:02d}" for m in range(3, 10)]
+    assert months["2026-03"] == 0       # 3/30 は範囲外
+    assert months["2026-09"] == 4000    # 9/29 は範囲内（終端を含む）
+    assert result["total"] == 4000
+    assert [e["ex_date"] for e in result["entries"]] == ["2026-09-29"]
+
+    # 月の途中で始まり同じ月で終わる期間
+    single = calendar.query(date(2027, 3, 15), date(2027, 3, 30))
+    assert single["months"] == [{"month": "2027-03", "total": 6000}]
+
+
+def test_static_schedule_and_estimated_fallback(index):
+    static = [{"month": 6, "entries": [
+        {"ticker": "9432", "ex_date": "2026-06-27", "payment_date": "2026-09-01", "note": "期末"},
+    ]}]
+    holdings = [_holding(), _holding("9432", annual=5.0), _holding("8306", annual=40.0)]
+    calendar = DividendCalendar(holdings, index, static, 2026, 2026)
+    entries = calendar.query(date(2026, 1, 1), date(2026, 12, 31))["entries"]
+
+    by_ticker = {}
+    for e in entries:
+        by_ticker.setdefault(e["ticker"], []).append(e)
+    assert [(e["ex_date"], e["payment_date"], e["amount"], e["source"]) for e in by_ticker["9432"]] == [
+        ("2026-06-27", "2026-09-01", 500, "static"),
+    ]
+    # 実績も静的スケジュールもない銘柄は3月・9月に半額ずつ
+    assert [(e["ex_date"], e["amount"], e["source"]) for e in by_ticker["8306"]] == [
+        ("2026-03-30", 2000, "estimated"), ("2026-09-28", 2000, "estimated"),
+    ]
+
+
+def test_deferred_save_writes_once(tmp_path, monkeypatch):
+    idx = DividendEventIndex(str(tmp_path / "events.json"))
+    saves = []
+    real_save = idx._save
+    monkeypatch.setattr(idx, "_save", lambda: (saves.append(1), real_save()))
+
+    with idx.deferred_save():
+        for i in range(20):
+            idx.update(str(1301 + i), {"a": {"amount": 10.0, "date": _ts("2026-03-30")}})
+        assert saves == []
+    assert saves == [1]
+    assert len(DividendEventIndex(str(tmp_path / "events.json")).events("1320")) == 1
+
+
+def test_get_calendar_is_cached_per_user():
+    a = [_holding("7203")]
+    b = [_holding("9432", annual=5.0)]
+    first = get_calendar("u1", a, [], 2026, 2026)
+    assert get_calendar("u2", b, [], 2026, 2026) is not first
+    # 他のユーザーを挟んでも作り直さない
+    assert get_calendar("u1", a, [], 2026, 2026) is first
+    assert get_calendar("u1", [_holding("7203", shares=200)], [], 2026, 2026) is not first
@@ -0,0 +1,131 @@
+"""FirestoreWriteBehind のキュー動作（偽の Firestore クライアントで検証）"""
+
+import json
+import os
+
+import pytest
+
+from firestore_sync import FirestoreWriteBehind
+
+
+class FakeFirestore:
+    """collection/document/batch だけを持つ Firestore の代用品。ops に書き込み内容を記録する。"""
+
+    def __init__(self):
+        self.ops: list[tuple] = []
+        self.fail = False
+
+    def collection(self, name):
+        return _FakeRef((name,))
+
+    def batch(self):
+        return _FakeBatch(self)
+
+
+class _FakeRef:
+    def __init__(self, path):
+        self.path = path
+
+    def document(self, name):
+        return _FakeRef(self.path + (name,))
+
+    def collection(self, name):
+        return _FakeRef(self.path + (name,))
+
+
+class _FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, ref, data):
+        self._ops.append(("set", "/".join(ref.path), data))
+
+    def delete(self, ref):
+        self._ops.append(("delete", "/".join(ref.path), None))
+
+    def commit(self):
+        if self._db.fail:
+            raise RuntimeError("unavailable")
+        self._db.ops.extend(self._ops)
+
+
+@pytest.fixture
+def db():
+    return FakeFirestore()
+
+
+def _make_queue(db, journal):
+    # 反映はテストから flush() で明示的に行う
+    return FirestoreWriteBehind(client_factory=lambda: db, journal_file=str(journal), flush_interval=3600)
+
+
+def test_set_then_delete_on_same_ticker_is_coalesced(db, tmp_path):
+    queue = _make_queue(db, tmp_path / "journal.jsonl")
+    queue.enqueue_set("u1", "7203", {"ticker": "7203", "shares": 100})
+    queue.enqueue_set("u1", "7203", {"ticker": "7203", "shares": 200})
+    queue.enqueue_delete("u1", "7203")
+    queue.enqueue_set("u1", "9432", {"ticker": "9432", "shares": 10})
+    assert queue.pending_count() == 2
+
+    assert queue.flush()
+    assert sorted(db.ops) == [
+        ("delete", "users/u1/holdings/7203", None),
+        ("set", "users/u1/holdings/9432", {"ticker": "9432", "shares": 10}),
+    ]
+    assert queue.pending_count() == 0
+    assert (tmp_path / "journal.jsonl").read_text(encoding="utf-8") == ""
+
+
+def test_failed_flush_is_replayed_from_journal(db, tmp_path):
+    journal = tmp_path / "journal.jsonl"
+    queue = _make_queue(db, journal)
+    db.fail = True
+    queue.enqueue_set("u1", "7203", {"ticker": "7203", "shares": 100})
+    queue.enqueue_delete("u1", "7203")
+    queue.enqueue_set("u2", "8306", {"ticker": "8306", "shares": 300})
+
+    assert not queue.flush()
+    assert queue.pending_count() == 2
+    assert len(journal.read_text(encoding="utf-8").splitlines()) == 3
+
+    # 再起動を想定して新しいキューでジャーナルを読み戻す
+    db.fail = False
+    restarted = _make_queue(db, journal)
+    assert restarted.recover() == 2
+    assert restarted.flush()
+    assert sorted(db.ops) == [
+        ("delete", "users/u1/holdings/7203", None),
+        ("set", "users/u2/holdings/8306", {"ticker": "8306", "shares": 300}),
+    ]
+    assert journal.read_text(encoding="utf-8") == ""
+
+
+def test_recover_uses_latest_sequence_regardless_of_line_order(db, tmp_path):
+    journal = tmp_path / "journal.jsonl"
+    records = [
+        {"uid": "u1", "ticker": "7203", "op": "delete", "data": None, "seq": 2},
+        {"uid": "u1", "ticker": "7203", "op": "set", "data": {"shares": 100}, "seq": 1},
+    ]
+    journal.write_text("".join(json.dumps(r) + "\n" for r in records) + '{"uid": "u1", "tick', encoding="utf-8")
+
+    queue = _make_queue(db, journal)
+    assert queue.recover() == 1
+    assert queue.flush()
+    assert db.ops == [("delete", "users/u1/holdings/7203", None)]
+
+
+def test_enqueue_many_journals_once(db, tmp_path, monkeypatch):
+    journal = tmp_path / "journal.jsonl"
+    queue = _make_queue(db, journal)
+    fsyncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+
+    holdings = [{"ticker": str(1301 + i), "shares": 100} for i in range(50)]
+    queue.enqueue_many("u1", holdings)
+    assert len(fsyncs) == 1
+    assert len(journal.read_text(encoding="utf-8").splitlines()) == 50
+
+    assert queue.flush()
+    assert len(db.ops) == 50
@@ -0,0 +1,24 @@
+"""NewsTextMatcher のタグ除去・カテゴリ判定・言及検出"""
+
+from news_fetcher import NewsTextMatcher
+
+MATCHER = NewsTextMatcher([("8306", "三菱UFJ"), ("7203", "トヨタ自動車"), ("", "")])
+
+
+def test_angle_brackets_in_titles_are_text_not_tags():
+    assert MATCHER.process("増配 <8306>", "") == ("", "配当", ["8306"])
+    assert MATCHER.process("<決算>トヨタ自動車、最高益", "") == ("", "業績", ["7203"])
+
+
+def test_summary_tags_are_stripped_and_mentions_collected():
+    summary, category, mentioned = MATCHER.process("市況", "<p>三菱UFJと<b>7203</b>が上昇</p>")
+    assert summary == "三菱UFJと7203が上昇"
+    assert category == "ニュース"
+    assert mentioned == ["7203", "8306"]
+
+
+def test_category_priority_and_code_boundaries():
+    # 複数カテゴリに当たる場合は配当 > 業績 > 株価
+    assert MATCHER.process("株価上昇、決算で増配", "")[1] == "配当"
+    # 数字の一部になっている証券コードは言及とみなさない
+    assert MATCHER.process("27203円で推移", "")[2] == []
@@ -0,0 +1,137 @@
+"""PortfolioStore の旧共有ポートフォリオからの移行（偽の Firestore クライアントで検証）"""
+
+import json
+
+import pytest
+
+from portfolio_store import MIGRATED_FIELD, PortfolioStore
+
+
+class FakeFirestore:
+    """パス → ドキュメントの辞書で Firestore を模したもの"""
+
+    def __init__(self, docs=None):
+        self.docs: dict[tuple, dict] = dict(docs or {})
+        self.writes = 0
+
+    def collection(self, name):
+        return _FakeRef(self, (name,))
+
+    def batch(self):
+        return _FakeBatch(self)
+
+
+class _FakeSnapshot:
+    def __init__(self, ref, data):
+        self.id = ref.path[-1]
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _FakeRef:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path[-1]
+
+    def document(self, name):
+        return _FakeRef(self._db, self.path + (name,))
+
+    def collection(self, name):
+        return _FakeRef(self._db, self.path + (name,))
+
+    def get(self):
+        return _FakeSnapshot(self, self._db.docs.get(self.path))
+
+    def set(self, data):
+        self._db.writes += 1
+        self._db.docs[self.path] = dict(data)
+
+    def _children(self):
+        n = len(self.path) + 1
+        # 親ドキュメントのないサブコレクションも list_documents には現れる
+        return sorted({p[:n] for p in self._db.docs if len(p) >= n and p[:n - 1] == self.path})
+
+    def list_documents(self):
+        return [_FakeRef(self._db, p) for p in self._children()]
+
+    def stream(self):
+        return [_FakeSnapshot(_FakeRef(self._db, p), self._db.docs[p]) for p in self._children() if p in self._db.docs]
+
+
+class _FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append((ref.path, data, merge))
+
+    def delete(self, ref):
+        self._ops.append((ref.path, None, False))
+
+    def commit(self):
+        self._db.writes += 1
+        for path, data, merge in self._ops:
+            if data is None:
+                self._db.docs.pop(path, None)
+            else:
+                self._db.docs[path] = {**self._db.docs.get(path, {}), **data} if merge else dict(data)
+
+
+LEGACY = [{"ticker": "7203", "name": "トヨタ自動車", "shares": 100}]
+
+
+def _store(tmp_path, db):
+    stocks = tmp_path / "stocks.json"
+    stocks.write_text(json.dumps({"holdings": LEGACY}, ensure_ascii=False), encoding="utf-8")
+    return PortfolioStore(str(stocks), str(tmp_path / "portfolios"), client_factory=lambda: db)
+
+
+def _holding_doc(ticker, shares):
+    return {"ticker": ticker, "name": ticker, "shares": shares}
+
+
+def test_migration_without_firestore_writes_nothing(tmp_path):
+    store = _store(tmp_path, None)
+    with pytest.raises(RuntimeError):
+        store.migrate_legacy()
+    assert not (tmp_path / "portfolios").exists()
+
+
+def test_migration_reconciles_firestore_and_marks_users(tmp_path):
+    db = FakeFirestore({
+        ("users", "u1", "holdings", "7203"): _holding_doc("7203", 50),
+        ("users", "u1", "holdings", "9432"): _holding_doc("9432", 10),  # 共有側で削除済み
+    })
+    store = _store(tmp_path, db)
+    assert store.get("u1") == LEGACY  # 移行前は共有ポートフォリオを見せる
+
+    assert store.migrate_legacy() == {"u1": LEGACY}
+    assert db.docs[("users", "u1", "holdings", "7203")] == LEGACY[0]
+    assert ("users", "u1", "holdings", "9432") not in db.docs
+    assert MIGRATED_FIELD in db.docs[("users", "u1")]
+    assert db.docs[("meta", "portfolio_migration")]["users"] == 1
+
+
+def test_rerun_after_files_are_lost_keeps_firestore_data(tmp_path):
+    db = FakeFirestore({
+        ("users", "u1"): {MIGRATED_FIELD: "2026-01-01T00:00:00"},
+        ("users", "u1", "holdings", "9432"): _holding_doc("9432", 10),
+        ("users", "u2", "holdings", "8306"): _holding_doc("8306", 300),
+    })
+    store = _store(tmp_path, db)
+    # 再デプロイでファイルが消えても、移行済みのユーザーは Firestore から読む
+    assert store.get("u1") == [_holding_doc("9432", 10)]
+
+    assert list(store.migrate_legacy()) == ["u2"]
+    assert db.docs[("users", "u1", "holdings", "9432")] == _holding_doc("9432", 10)
+    assert ("users", "u2", "holdings", "8306") not in db.docs
+
+    # 全体の印があれば、ファイルのない新しいストアでも Firestore から読む
+    fresh = PortfolioStore(str(tmp_path / "stocks.json"), str(tmp_path / "other"), client_factory=lambda: db)
+    assert fresh.get("u3") == []
+    assert fresh.get("u2") == LEGACY
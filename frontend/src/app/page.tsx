@@ -4,7 +4,7 @@ import { useEffect, useState, useCallback } from "react";
 import { TrendingUp, CalendarDays, Percent, RefreshCw } from "lucide-react";
 import PortfolioChart from "@/components/PortfolioChart";
 
-import { getApiBaseUrl, authFetch } from "@/lib/api";
+import { getApiBaseUrl, authFetch, openPriceStream } from "@/lib/api";
 
 const API_BASE = getApiBaseUrl();
 
@@ -43,6 +43,30 @@ function formatUpdatedAt(isoStr: string | null): string {
   return `${d.getHours()}:${String(d.getMinutes()).padStart(2, "0")} 更新`;
 }
 
+/**
+ * 配信された株価をポートフォリオに反映し、評価額・総資産・利回りを計算し直す。
+ * 計算は /api/portfolio と同じ。
+ */
+function applyPrices(
+  portfolio: Portfolio,
+  prices: Record<string, number>,
+  updatedAt: string | null,
+): Portfolio {
+  const holdings = portfolio.holdings.map((h) => {
+    const price = prices[h.ticker];
+    if (price === undefined) return h;
+    return { ...h, current_price: price, market_value: price * h.shares };
+  });
+  const total = holdings.reduce((sum, h) => sum + h.market_value, 0);
+  return {
+    ...portfolio,
+    holdings,
+    total_asset_value: Math.round(total),
+    dividend_yield: total > 0 ? Math.round((portfolio.annual_dividend / total) * 10000) / 100 : 0,
+    prices_updated_at: updatedAt ?? portfolio.prices_updated_at,
+  };
+}
+
 export default function DashboardPage() {
   const [portfolio, setPortfolio] = useState<Portfolio | null>(null);
   const [loading, setLoading] = useState(true);
@@ -84,6 +108,15 @@ export default function DashboardPage() {
     initialRefresh();
   }, [loadPortfolio]);
 
+  // 表示中の銘柄の株価をサーバーからのプッシュ配信で更新する（銘柄構成が変わったら購読し直す）
+  const tickerKey = portfolio ? portfolio.holdings.map((h) => h.ticker).join(",") : "";
+  useEffect(() => {
+    if (!tickerKey) return;
+    return openPriceStream((prices, updatedAt) => {
+      setPortfolio((current) => (current ? applyPrices(current, prices, updatedAt) : current));
+    }, tickerKey.split(","));
+  }, [tickerKey]);
+
   if (loading) {
     return (
       <div style={{ textAlign: "center", padding: "4rem 0" }}>
@@ -34,3 +34,58 @@ export const authFetch = async (url: string, options: RequestInit = {}): Promise
         },
     });
 };
+
+/**
+ * 株価のプッシュ配信（/api/stream/prices）に EventSource で接続する。
+ * EventSource は Authorization ヘッダーを付けられないため、接続のたびに短命トークンを発行して
+ * クエリに付ける。切断時（トークン期限切れ後の再接続失敗を含む）はトークンを取り直して再接続する。
+ * 戻り値の関数を呼ぶと接続を閉じる。
+ */
+export const openPriceStream = (
+    onPrices: (prices: Record<string, number>, updatedAt: string | null) => void,
+    tickers?: string[],
+): (() => void) => {
+    const base = getApiBaseUrl();
+    let source: EventSource | null = null;
+    let retryTimer: ReturnType<typeof setTimeout> | null = null;
+    let closed = false;
+
+    const connect = async () => {
+        try {
+            const res = await authFetch(`${base}/api/stream/token`, { method: "POST" });
+            const { token } = res.ok ? await res.json() : { token: null };
+            if (closed) return;
+
+            const params = new URLSearchParams();
+            if (token) params.set("token", token);
+            if (tickers?.length) params.set("tickers", tickers.join(","));
+            source = new EventSource(`${base}/api/stream/prices?${params}`);
+            source.addEventListener("prices", (event) => {
+                const data = JSON.parse((event as MessageEvent).data);
+                onPrices(data.prices, data.updated_at);
+            });
+            source.onerror = () => {
+                // 自動再接続は同じ（期限切れの）トークンを使うため、自前で取り直す
+                source?.close();
+                scheduleReconnect();
+            };
+        } catch {
+            scheduleReconnect();
+        }
+    };
+
+    const scheduleReconnect = () => {
+        if (closed || retryTimer) return;
+        retryTimer = setTimeout(() => {
+            retryTimer = null;
+            connect();
+        }, 5000);
+    };
+
+    connect();
+    return () => {
+        closed = true;
+        if (retryTimer) clearTimeout(retryTimer);
+        source?.close();
+    };
+};